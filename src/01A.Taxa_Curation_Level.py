@@ -4,28 +4,25 @@
 # In[5]:
 
 import os
-import time
 import pandas as pd
-from Bio import Entrez
 from pathlib import Path
+from genome_fetch import fetch_records
+from genome_store import open_store
+from vmr_index import load_vmr_index
 
 def retrieve_genomes(genera_list):
     # Read the genus or bunch of genera to run
     current_dir = Path.cwd()
     parent_dir = current_dir.parent
     print(parent_dir)
-    ICTV_assignation = pd.read_csv(f"{parent_dir}/phallett/data/Virus_Metadata_Resource/VMR.csv")
-    ICTV_assignation = ICTV_assignation.rename(columns=lambda x: x.strip())  # Remove leading/trailing whitespaces
-    ICTV_assignation.columns = ["Sort","Isolate_Sort","Realm","Subrealm","Kingdom","Subkingdom","Phylum","Subphylum","Class","Subclass","Order","Suborder","Family","Subfamily","Genus",
-"Subgenus","Species","Exemplar_or_additional_isolate","Virus_name(s)","Virus_name_abbreviation(s)","Virus_isolate_designation","Virus_GENBANK_accession","Virus_REFSEQ_accession",
-"Genome_coverage","Genome_composition","Host_source"]
-    ICTV_assignation = ICTV_assignation[(ICTV_assignation["Host_source"] == "archaea") | (ICTV_assignation["Host_source"] == "bacteria")]
-    ICTV_assignation = ICTV_assignation[(ICTV_assignation["Genome_coverage"] == "Complete genome") | (ICTV_assignation["Genome_coverage"] == "Complete coding genome")]
+    # Complete genomes of bacterial and archaeal viruses, precomputed in the VMR cache
+    vmr = load_vmr_index(f"{parent_dir}/phallett/data/Virus_Metadata_Resource/VMR.csv", "complete_prokaryotic")
+    ICTV_assignation = vmr.table
     ICTV_assignation.to_csv(f"{parent_dir}/phallett/test/ICTV_assignation_Complete.csv", index=False)
 
-    # Extract accessions for search on NCBI
-    accessions = ICTV_assignation["Virus_GENBANK_accession"].unique()
-    print(f"The number of phages with complete genome for all ICTV database is: {len(accessions)}")
+    # Genomes to search on NCBI, the segments of a segmented genome are one record (one VMR row)
+    records = vmr.records()
+    print(f"The number of phages with complete genome for all ICTV database is: {len(records)}")
 
     # Creates a folder for storage the selected taxas
     import os
@@ -35,12 +32,15 @@ def retrieve_genomes(genera_list):
     ncbi_genome_actual = os.path.expanduser(ncbi_genome_actual)
     os.makedirs(ncbi_genome_actual, exist_ok=True)
 
+    # Genomes already on disk are linked from the shared genome store instead of downloaded again
+    store = open_store(f"{parent_dir}/phallett/data")
+
     for genus in genera_list:
-        # Filter the ICTV assignation for the current genus
-        genus_data = ICTV_assignation[ICTV_assignation["Genus"] == genus]
+        # Genomes of the current genus from the accession index
+        genus_records = vmr.records(genus)
 
         # Check if there are any records found for the genus
-        if genus_data.empty:
+        if not genus_records:
             print(f"No records found for the genus: {genus}")
             continue
 
@@ -49,28 +49,12 @@ def retrieve_genomes(genera_list):
         print(f"Trying to create folder:{genus_folder}")
         os.makedirs(genus_folder, exist_ok=True)
 
-        # Iterate over accessions for the current genus
-        for accession in genus_data["Virus_GENBANK_accession"]:
-            file_name = f"{accession}.fasta"
-            file_path = os.path.join(genus_folder, file_name)
-
-            while True:
-                try:
-                    with Entrez.efetch(db="nucleotide", id=accession, rettype="fasta", retmode="text") as handle:
-                        seq = handle.read()
-                        if seq:
-                            with open(file_path, 'w') as file:
-                                file.write(seq)
-                            print(f"Downloaded {file_name}")
-                            break
-                except Exception as e:
-                    print(f"Error: {str(e)}")
-                    time.sleep(5)
-                    continue
-
-                # Check if the file was created
-                if os.path.exists(file_path):
-                    print(f"New FASTA file created: {file_path}")
+        # Download the genus accessions in batched, rate-limited requests, one file per genome with its
+        # segments concatenated and named by the first accession
+        downloaded, failed = fetch_records(genus_records, genus_folder, store=store)
+        print(f"Downloaded {len(downloaded)} genomes for {genus}")
+        if failed:
+            print(f"Could not download {len(failed)} accessions for {genus}: {', '.join(failed)}")
     
 if __name__ == "__main__":
     import sys
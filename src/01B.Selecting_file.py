@@ -2,19 +2,29 @@ import argparse
 import os
 import re
 import subprocess
+import csv
 import glob
 import pandas as pd
-from Bio.Blast import NCBIXML
-from Bio import Entrez
-import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path  
+from blast_db import ensure_blast_db
+from genome_fetch import fetch_genomes
+from genome_store import open_store
+from vmr_sync import sync_vmr
+from vmr_index import load_vmr_index
+from neighbor_index import NeighborIndex
 
 # Argument parsing options
 parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('-file', type=str, help='Path to the fasta file')
-parser.add_argument('-updatedb', type=str, default='false', help='Whether to update the database')
+parser.add_argument('-updatedb', type=str, default='false', help='Whether to update the database: true (incremental sync), full or false')
 parser.add_argument('-blastpor', type=float, help='BLAST percentage identity threshold')
 parser.add_argument('-evalue', type=float, help='BLAST e-value threshold')
+parser.add_argument('-queries', type=str, help='Directory of fasta files or multi-fasta file, one analysis per query')
+parser.add_argument('-threads', type=int, default=1, help='Threads for each blastn run (-num_threads)')
+parser.add_argument('-jobs', type=int, default=1, help='Number of queries searched at the same time')
+parser.add_argument('-neighbors', type=str, help='Neighbor index (.npz), queries already in it take their nearest genomes instead of running BLAST')
+parser.add_argument('-max_neighbors', type=int, default=50, help='Genomes taken from the neighbor index per query')
 args = parser.parse_args()
 
 print(vars(args))
@@ -24,94 +34,29 @@ current_dir = Path.cwd()
 parent_dir = current_dir.parent
 ICTV_database = Path(parent_dir) / "phallett" / "data" / "ICTV_database"
 
-if args.updatedb.lower() == "true":
-    ICTV_database.mkdir(parents=True, exist_ok=True)
-    Entrez.email = "na.portilla10@uniandes.edu.co"
-    guide_accessions = pd.read_csv(Path(parent_dir) / "phallett" / "data" / "Virus_Metadata_Resource" / "VMR.csv")
+# Shared genome store, genomes already on disk are never downloaded twice
+store = open_store(Path(parent_dir) / "phallett" / "data")
 
-    for accession in guide_accessions['Virus GENBANK accession']:
-        try:
-            print(f"Downloading {accession}")
-            with Entrez.efetch(db="nucleotide", id=accession, rettype="fasta", retmode="text") as handle:
-                with open(ICTV_database / f"{accession}.fasta", "w") as f:
-                    f.write(handle.read())
-        except Exception as e:
-            print(f"Error al descargar {accession}: {e}. Saltando al siguiente.")
+vmr_path = Path(parent_dir) / "phallett" / "data" / "Virus_Metadata_Resource" / "VMR.csv"
+if args.updatedb.lower() in ("true", "full"):
+    # Incremental sync against the last VMR snapshot, "full" rebuilds the snapshot from the genomes on disk
+    # so every file is checked again (removed ones deleted, versions compared with NCBI)
+    sync_vmr(vmr_path, ICTV_database, store=store, full=args.updatedb.lower() == "full")
 else:
     print("Database not updated")
 
-if args.file:
-    # Create a new analysis folder
-    existing_folders = glob.glob(str(Path(parent_dir) / "phallett" / "data" / "Taxa_Selected" / "*"))
-    existing_numbers = [int(re.search(r'analysis_(\d+)', folder).group(1)) for folder in existing_folders if re.search(r'analysis_(\d+)', folder)]
-    next_number = max(existing_numbers) + 1 if existing_numbers else 1
-    analysis_folder = Path(parent_dir) / "phallett" / "data" / "Taxa_Selected" / f"analysis_{next_number}"
-    analysis_folder.mkdir(parents=True, exist_ok=True)
-    print(f"Analysis folder created: {analysis_folder}")
-
-    # Read the fasta file
-    file_path = Path(args.file)  # Use the user-provided file path
-    fasta_string = file_path.read_text()
-    print(fasta_string)
-
-    # Format the database
-    combined_fasta = Path(parent_dir) / "phallett" / "data" / "ICTV_database_combined.fasta"
-    
-    # Check if the ICTV_database folder is empty before concatenating
-    if any(ICTV_database.glob("*.fasta")):
-        command = f"cat {ICTV_database}/*.fasta > {combined_fasta}"
-        subprocess.run(command, shell=True)
-
-        # Create the BLAST database
-        command = f"makeblastdb -in {combined_fasta} -dbtype nucl"
-        subprocess.run(command, shell=True)
-
-    # Save the query fasta file
-    fasta_file_name = os.path.basename(args.file)  # Get the original file name
-    fasta_file_path = analysis_folder / fasta_file_name
-    fasta_file_path.write_text(fasta_string)
-    print("Query Fasta file saved")
-
-    # Search on BLAST
-    command = f"blastn -query {fasta_file_path} -db {combined_fasta} -out result.xml -outfmt 5"
-    result = subprocess.run(command, shell=True)
-
-    if result.returncode == 0:
-        print("BLAST executed successfully")
-    else:
-        print("Error al ejecutar BLAST")
-
-# Parse BLAST results
-result_handle = open("result.xml")
-blast_records = NCBIXML.parse(result_handle)
+# Tabular BLAST output, only the columns needed to filter the hits and name the subject
+BLAST_COLUMNS = ["qseqid", "stitle", "nident", "length", "evalue"]
 
 def clean_filename(filename):
-    # Clean the filename
-    filename = filename.split(' ', 1)[-1]
+    # Clean the filename, the subject title starts with the accession (AB008550.1 Pseudomonas phage ...)
+    filename = filename.split(' ', 1)[0]
     filename = filename.split('.')[0]
     invalid_chars = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
     for char in invalid_chars:
         filename = filename.replace(char, '')
     return filename
 
-# Download sequences from BLAST
-for blast_record in blast_records:
-    for alignment in blast_record.alignments:
-        print(f"Alignment: {alignment.title}")
-        for hsp in alignment.hsps:
-            if hsp.identities / len(hsp.query) >= args.blastpor and hsp.expect < args.evalue:
-                print(f"Found match: {alignment.title}")
-                if alignment.accession:
-                    try:
-                        with Entrez.efetch(db="nucleotide", id=alignment.accession, rettype="fasta", retmode="text") as handle:
-                            valid_filename = clean_filename(alignment.title)
-                            with open(analysis_folder / f"{valid_filename}.fasta", "w") as f:
-                                f.write(handle.read())
-                    except urllib.error.HTTPError as err:
-                        print(f"Error doing efetch: {err}")
-                else:
-                    print("Accession ID is empty. Cannot do efetch request.")
-
 # Remove empty files
 def remove_empty_files(directory):
     for filename in os.listdir(directory):
@@ -121,5 +66,163 @@ def remove_empty_files(directory):
                 print(f"Removing empty file: {file_path}")
                 os.remove(file_path)
 
-# Call the function on the analysis folder
-remove_empty_files(analysis_folder)
+def create_analysis_folder(taxa_selected):
+    # Take the next free analysis_N, the folder is created without exist_ok so two runs never share it
+    while True:
+        existing_folders = glob.glob(str(taxa_selected / "*"))
+        existing_numbers = [int(re.search(r'analysis_(\d+)', folder).group(1)) for folder in existing_folders if re.search(r'analysis_(\d+)', folder)]
+        next_number = max(existing_numbers) + 1 if existing_numbers else 1
+        analysis_folder = taxa_selected / f"analysis_{next_number}"
+        try:
+            analysis_folder.mkdir(parents=True)
+        except FileExistsError:
+            continue
+        print(f"Analysis folder created: {analysis_folder}")
+        return analysis_folder
+
+def fasta_records(text):
+    # (header ID, record text) of every record of a fasta file, in file order and duplicates included
+    records = []
+    for line in text.splitlines():
+        if line.startswith(">"):
+            header = line[1:].split(None, 1)
+            records.append((header[0] if header else "", [line]))
+        elif records and line.strip():
+            records[-1][1].append(line)
+    return [(record_id, "\n".join(lines) + "\n") for record_id, lines in records]
+
+def query_id(record_id):
+    # Header ID safe as a file name (gi|123|gb|AB008550.1| -> gi_123_gb_AB008550.1)
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', record_id).strip('_') or "query"
+
+def read_queries(path):
+    # A directory holds one query per fasta file, a multi-fasta file holds one query per record
+    path = Path(path)
+    if path.is_dir():
+        files = sorted(f for f in path.iterdir() if f.suffix in (".fasta", ".fa", ".fna"))
+        return [(f.name, f.read_text()) for f in files]
+    # Records are named by their position and ID, so records sharing an ID are all kept
+    queries = []
+    seen = {}
+    for index, (record_id, record) in enumerate(fasta_records(path.read_text()), start=1):
+        name = query_id(record_id)
+        if name in seen:
+            print(f"Warning: record {index} of {path.name} has the same ID as record {seen[name]} ({record_id}), both are kept")
+        seen.setdefault(name, index)
+        queries.append((f"{index}_{name}.fasta", record))
+    return queries
+
+def run_blast(query_path, blast_database, result_path, threads):
+    # Search on BLAST, each query writes its result inside its own analysis folder
+    command = ["blastn", "-query", str(query_path), "-db", str(blast_database), "-out", str(result_path),
+               "-outfmt", "6 " + " ".join(BLAST_COLUMNS), "-num_threads", str(threads)]
+    result = subprocess.run(command)
+
+    if result.returncode == 0:
+        print(f"BLAST executed successfully for {query_path.name}")
+    else:
+        print(f"Error al ejecutar BLAST para {query_path.name}")
+    return result.returncode == 0
+
+def collect_matches(result_path, blastpor, evalue):
+    # Stream the tabular BLAST results and keep each subject accession once, in order of first passing HSP
+    matches = {}
+    with open(result_path, newline="") as result_handle:
+        for row in csv.reader(result_handle, delimiter="\t"):
+            if not row or row[0].startswith("#"):
+                continue
+            hit = dict(zip(BLAST_COLUMNS, row))
+            if int(hit["nident"]) / int(hit["length"]) >= blastpor and float(hit["evalue"]) < evalue:
+                valid_filename = clean_filename(hit["stitle"])
+                if not valid_filename:
+                    print("Accession ID is empty. Cannot do efetch request.")
+                elif valid_filename not in matches:
+                    print(f"Found match: {hit['stitle']}")
+                    matches[valid_filename] = hit
+    return matches
+
+def query_accession(fasta_string):
+    # Accession of the first record of the query, as in the subject titles
+    header = fasta_string.lstrip().split("\n", 1)[0].lstrip(">")
+    return clean_filename(header)
+
+def neighbor_matches(neighbors, accession, max_neighbors):
+    # Nearest genomes of a query already in the neighbor index, in the same form as collect_matches
+    nearest = neighbors.nearest(accession, max_neighbors)
+    return {genome: {"distance": round(float(distance), 6)} for genome, distance in zip(nearest["genome"], nearest["distance"])}
+
+def write_matches(analysis_folder, matches, vmr):
+    # Table of the selected subjects with their ICTV taxonomy, from a single lookup in the VMR index
+    hits = list(matches.values())
+    if hits and "distance" in hits[0]:
+        table = pd.DataFrame({"accession": list(matches), "distance": [hit["distance"] for hit in hits]})
+    else:
+        table = pd.DataFrame({"accession": list(matches),
+                              "identity": [int(hit["nident"]) / int(hit["length"]) for hit in hits],
+                              "evalue": [hit["evalue"] for hit in hits]})
+    if vmr is not None:
+        for column in ["Family", "Genus", "Species"]:
+            table[column] = vmr.annotate(table["accession"], column)
+    table.to_csv(analysis_folder / "matches.tsv", sep="\t", index=False)
+
+queries = []
+if args.file:
+    # Read the fasta file, a single query even when it has several records
+    file_path = Path(args.file)  # Use the user-provided file path
+    queries.append((os.path.basename(args.file), file_path.read_text()))
+if args.queries:
+    queries.extend(read_queries(args.queries))
+
+if queries:
+    # Format the database, only rebuilt or extended when ICTV_database changed
+    blast_database = Path(parent_dir) / "phallett" / "data" / "ICTV_blastdb" / "ICTV_database"
+    if any(ICTV_database.glob("*.fasta")):
+        blast_database = ensure_blast_db(ICTV_database, blast_database.parent)
+
+    # Create a new analysis folder per query and save the query fasta file
+    taxa_selected = Path(parent_dir) / "phallett" / "data" / "Taxa_Selected"
+    analyses = []
+    for fasta_file_name, fasta_string in queries:
+        analysis_folder = create_analysis_folder(taxa_selected)
+        fasta_file_path = analysis_folder / fasta_file_name
+        fasta_file_path.write_text(fasta_string)
+        print(f"Query Fasta file saved: {fasta_file_path}")
+        analyses.append((analysis_folder, fasta_file_path))
+
+    # VMR taxonomy of the hits, loaded once for all the queries
+    vmr = load_vmr_index(vmr_path) if vmr_path.exists() else None
+
+    # Queries already in the neighbor index take their nearest genomes from it, without BLAST
+    neighbor_hits = {}
+    if args.neighbors:
+        neighbors = NeighborIndex.load(args.neighbors)
+        for analysis_folder, fasta_file_path in analyses:
+            accession = query_accession(fasta_file_path.read_text())
+            if accession in neighbors:
+                neighbor_hits[analysis_folder] = neighbor_matches(neighbors, accession, args.max_neighbors)
+                print(f"{fasta_file_path.name}: {len(neighbor_hits[analysis_folder])} genomes from the neighbor index")
+    blast_analyses = [analysis for analysis in analyses if analysis[0] not in neighbor_hits]
+
+    # Run the BLAST searches, -jobs queries at a time
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        succeeded = list(executor.map(lambda analysis: run_blast(analysis[1], blast_database, analysis[0] / "result.tsv", args.threads), blast_analyses))
+    succeeded = dict(zip([analysis[0] for analysis in blast_analyses], succeeded))
+
+    for analysis_folder, fasta_file_path in analyses:
+        if analysis_folder in neighbor_hits:
+            matches = neighbor_hits[analysis_folder]
+        elif succeeded[analysis_folder]:
+            matches = collect_matches(analysis_folder / "result.tsv", args.blastpor, args.evalue)
+            print(f"{len(matches)} subject genomes passed the filters for {fasta_file_path.name}")
+        else:
+            continue
+
+        write_matches(analysis_folder, matches, vmr)
+
+        # Link the matches from the genome store, downloading only the ones missing
+        downloaded, failed = fetch_genomes(list(matches), analysis_folder, store=store)
+        if failed:
+            print(f"Error doing efetch: {', '.join(failed)}")
+
+        # Call the function on the analysis folder
+        remove_empty_files(analysis_folder)
@@ -5,9 +5,13 @@ evalue=1e-5
 parent_dir=$(dirname "$PWD")
 file="$parent_dir/phallett/GCF_000836945.fasta"
 updatedb="false"
+queries=""
+threads=1
+jobs=1
+neighbors=""
 
 # Parse command-line options
-while getopts "m:f:b:e:u:" opt; do  
+while getopts "m:f:b:e:u:q:t:j:n:" opt; do  
   case $opt in
     m)
       module=$OPTARG
@@ -24,11 +28,33 @@ while getopts "m:f:b:e:u:" opt; do
     u)
       updatedb=$OPTARG
       ;;  
+    q)
+      queries=$OPTARG
+      ;;
+    t)
+      threads=$OPTARG
+      ;;
+    j)
+      jobs=$OPTARG
+      ;;
+    n)
+      # Neighbor index built by src/neighbor_index.py, known queries skip BLAST
+      neighbors=$OPTARG
+      ;;
     \?)
       echo "Invalid option: -$OPTARG" >&2
       ;;
   esac
 done
 
-# Now running the Python script for file module
-python3 "$parent_dir/phallett/src/01B.Selecting_file.py" -file "$file" -updatedb "$updatedb" -blastpor "$blastpor" -evalue "$evalue"
+neighbor_options=()
+if [ -n "$neighbors" ]; then
+  neighbor_options=(-neighbors "$neighbors")
+fi
+
+# Now running the Python script for file module, a directory or multi-fasta in -q runs in batch mode
+if [ -n "$queries" ]; then
+  python3 "$parent_dir/phallett/src/01B.Selecting_file.py" -queries "$queries" -updatedb "$updatedb" -blastpor "$blastpor" -evalue "$evalue" -threads "$threads" -jobs "$jobs" "${neighbor_options[@]}"
+else
+  python3 "$parent_dir/phallett/src/01B.Selecting_file.py" -file "$file" -updatedb "$updatedb" -blastpor "$blastpor" -evalue "$evalue" -threads "$threads" -jobs "$jobs" "${neighbor_options[@]}"
+fi
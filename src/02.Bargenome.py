@@ -1,22 +1,18 @@
 import argparse
 import pandas as pd
 from pathlib import Path
-from Bio import SeqIO
 import matplotlib.pyplot as plt
 import seaborn as sns
+from results_io import write_table
+from fasta_stats import open_stats_cache, gc_content
+from vmr_index import load_vmr_index
 
 # Global variables for the plot function
 df = None
 output_directory = None
 folder_name = None
 
-def calculate_genome_size(fasta_file):
-    genome_size = 0
-    for record in SeqIO.parse(fasta_file, "fasta"):
-        genome_size += len(record.seq)
-    return genome_size
-
-def extract_data_from_folders(parent_dir):
+def extract_data_from_folders(parent_dir, table_format="csv"):
     global df, output_directory, folder_name
     
     # Define paths
@@ -24,9 +20,9 @@ def extract_data_from_folders(parent_dir):
     general_path = Path(parent_dir) / "phallett" / "test" / "Metrics_Results"
     vmr_file_path = Path(parent_dir) / "phallett" / "data" / "Virus_Metadata_Resource" / "VMR.csv"
     
-    # Read the VMR CSV into a DataFrame
+    # Load the VMR once, indexed by accession (segmented genomes have one entry per segment)
     try:
-        vmr_df = pd.read_csv(vmr_file_path)
+        vmr = load_vmr_index(vmr_file_path)
     except FileNotFoundError:
         print(f"Error: VMR.csv not found at {vmr_file_path}")
         return
@@ -34,34 +30,38 @@ def extract_data_from_folders(parent_dir):
         print("Error: VMR.csv is empty.")
         return
 
+    # Genome stats are cached by file size and mtime, unchanged genomes are not read again
+    stats_cache = open_stats_cache(Path(parent_dir) / "phallett" / "data")
+
+    # Stats of every selected genome, the file name is the accession
+    genomes = []
+    for folder in data_taxa_selected.iterdir():
+        if folder.is_dir():
+            for file in folder.glob("*.fasta"):
+                stats = stats_cache.get(file)
+                genomes.append({'Folder': folder.name, 'Virus_GENBANK_accession': file.stem, 'Genome Size': stats["length"],
+                                'GC Content': gc_content(stats), 'N Count': stats["n"], 'Contigs': stats["contigs"]})
+    stats_cache.save()
+    genomes = pd.DataFrame(genomes, columns=['Folder', 'Virus_GENBANK_accession', 'Genome Size', 'GC Content', 'N Count', 'Contigs'])
+
+    # VMR metadata of all the selected genomes in a single lookup, genomes not in the VMR are left out
+    positions = vmr.positions(genomes['Virus_GENBANK_accession'])
+    genomes = genomes[positions >= 0].reset_index(drop=True)
+    metadata = vmr.table.iloc[positions[positions >= 0]].reset_index(drop=True)
+    metadata['Virus_GENBANK_accession'] = genomes['Virus_GENBANK_accession']
+    metadata = pd.concat([metadata, genomes.drop(columns=['Virus_GENBANK_accession'])], axis=1)
+
     # Process each folder in the Taxa_Selected directory
     for folder_name in data_taxa_selected.iterdir():
         if folder_name.is_dir():
-            # Initialize a list to store the data for the current folder
-            result_data = []
-
-            # Iterate through files in the folder
-            for file in folder_name.iterdir():
-                if file.is_file():
-                    # Extract the Virus_GENBANK_accession from the file name
-                    virus_accession = file.stem  # Assuming the file name matches the accession number
-                    if file.suffix == '.fasta':
-                        genome_size = calculate_genome_size(file)
-                        genome_size_info = {'Virus GENBANK accession': virus_accession, 'Genome Size': genome_size}
-
-                        # Append to the metadata 
-                        if virus_accession in vmr_df['Virus GENBANK accession'].values:
-                            metadata_row = vmr_df[vmr_df['Virus GENBANK accession'] == virus_accession].iloc[0].to_dict()
-                            metadata_row.update(genome_size_info)
-                            result_data.append(metadata_row)
-                    else:
-                        if virus_accession in vmr_df['Virus GENBANK accession'].values:
-                            metadata_row = vmr_df[vmr_df['Virus GENBANK accession'] == virus_accession].iloc[0].to_dict()
-                            result_data.append(metadata_row)
+            result_data = metadata[metadata['Folder'] == folder_name.name].drop(columns=['Folder'])
 
             # Concatenate all collected data into a single DataFrame for the current folder
-            if result_data:
-                df = pd.DataFrame(result_data)
+            if not result_data.empty:
+                df = result_data.reset_index(drop=True)
+                # Only the genera, families... of this folder, so the plot legend does not list the whole VMR
+                for column in df.select_dtypes("category").columns:
+                    df[column] = df[column].cat.remove_unused_categories()
                 print(f"Data for {folder_name.name}:")
                 print(df.head())  # Print the first few rows of the DataFrame for inspection
 
@@ -75,8 +75,7 @@ def extract_data_from_folders(parent_dir):
                 output_directory.mkdir(parents=True, exist_ok=True)  # Create the directory if it doesn't exist
 
                 # Define the output file path for the current folder
-                output_file = output_directory / f"metadata_{folder_name.name}.csv"
-                df.to_csv(output_file, index=False)
+                write_table(df, output_directory, "metadata", folder_name.name, table_format)
                 
                 # Generate and save the bar plot
                 plot_barplot(folder_name)
@@ -96,7 +95,7 @@ def plot_barplot(folder_name):
     try:
         # Create bar plot with hue for genera
         plt.figure(figsize=(14, 12))  # Increased height to provide more space for the legend
-        barplot = sns.barplot(data=df, x='Virus GENBANK accession', y='Genome Size', hue='Genus', palette='Set2')
+        barplot = sns.barplot(data=df, x='Virus_GENBANK_accession', y='Genome Size', hue='Genus', palette='Set2')
         plt.xticks(rotation=90)
         plt.title(f'Genome Sizes by Virus GENBANK Accession for {folder_name.name}')
         plt.xlabel('Virus GENBANK Accession')
@@ -133,12 +132,13 @@ def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description='Process folders and extract data from files.')
     parser.add_argument('parent_directory', type=str, help='Path to the parent directory')
+    parser.add_argument('--format', type=str, default="csv", choices=["csv", "parquet"], help='Format of the metadata table')
 
     # Parse the arguments
     args = parser.parse_args()
     
     # Call the extraction function
-    extract_data_from_folders(args.parent_directory)
+    extract_data_from_folders(args.parent_directory, args.format)
 
 if __name__ == "__main__":
     main()
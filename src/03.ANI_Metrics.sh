@@ -4,8 +4,10 @@
 kmers=(12 11 10 9 8)
 frag_lengths=(500)  # Default fragment 
 genus=""
+engine="fastani"
+prefilter=""
 
-while getopts "k:f:g:" opt; do
+while getopts "k:f:g:e:p:" opt; do
   case $opt in
     k)
       kmers=($OPTARG)
@@ -16,6 +18,14 @@ while getopts "k:f:g:" opt; do
     g)
       genus=($OPTARG)
       ;;
+    e)
+      # fastani (CLI) or native (in-process engine, src/fragment_ani.py)
+      engine=$OPTARG
+      ;;
+    p)
+      # Mash distance over which pairs are not sent to fastANI/skani (src/ani_prefilter.py)
+      prefilter=$OPTARG
+      ;;
     \?)
       echo "Invalid option: -$OPTARG" >&2
       exit 1
@@ -23,21 +33,20 @@ while getopts "k:f:g:" opt; do
   esac
 done
 
+# Algorithm label of the fragment based ANI rows, the native engine is stored apart from fastANI
+fragment_algorithm="fastani"
+if [ "$engine" == "native" ]; then
+  fragment_algorithm="native_ani"
+fi
+
+# Set when a fastANI run fails, the script then exits with an error after every genus
+failed=false
+
 # Create variables for paths
 parent_dir=$(dirname "$PWD")
 source="$parent_dir/phallett/data/Taxa_Selected"
 outdir="$parent_dir/phallett/test/Metrics_Results"
 
-cd "$source"
-
-subdirs=($(find "$source" -mindepth 1 -type d))
-for subdir in "${subdirs[@]}" ; do
-cd $subdir
-genusname=${subdir##*/}
-mv "${subdir}/signatures_${genusname}" "${outdir}/"
-echo "The moving signatures were sucessful"
-done
-
 # Create a list of subdirectories within the working directory
 if [ -n "$genus" ]; then
   # If a genus name is provided, only process that genus
@@ -47,15 +56,66 @@ else
   subdirs=($(find "$source" -mindepth 1 -type d))
 fi
 
+# Only absolute per-genus paths below, several genera can run at the same time (pipeline.py -jobs)
 for subdir in "${subdirs[@]}"; do
   genusname=${subdir##*/}
+  if [ -d "${subdir}/signatures_${genusname}" ]; then
+    mv "${subdir}/signatures_${genusname}" "${outdir}/"
+    echo "The moving signatures were sucessful"
+  fi
   fasta_files=("${subdir}"/*.fasta)
-  ls -d "${subdir}"/*.fasta > "${genusname}.list"
-  mv *.list "$outdir"
+  ls -d "${subdir}"/*.fasta > "$outdir/${genusname}.list"
 
   # Now we are going to calculate the ANI value. The file generated is interpreted as:
   # first column Ref_file, Query_file, ANI, Align_fraction_ref, Align_fraction_query, Ref_name, Query_Name
 
+  # Stored pairs of the genus, when they exist only genomes without pairs are compared against the rest
+  has_pairs=false
+  if ls "${outdir}/${genusname}/ani_metrics_${genusname}".* > /dev/null 2>&1; then
+    has_pairs=true
+  fi
+  declare -A skani_new=()
+  if [ "$has_pairs" == true ]; then
+    while read -r genome; do
+      skani_new["$genome"]=1
+    done < <(python3 "$parent_dir/phallett/src/pair_store.py" -dir "${outdir}/${genusname}" -genus "$genusname" -metric ani -algorithm skani -kmer static -list "$outdir/${genusname}.list")
+  else
+    for genome in "${fasta_files[@]}"; do
+      skani_new["$genome"]=1
+    done
+  fi
+  echo "${#skani_new[@]} genomes of $genusname without stored skani pairs"
+
+  # Mash prefilter, queries.tsv (query, --rl list) and pairs.tsv (allowed pairs) under prefilter_<genus>
+  declare -A allowed=()
+  prefilter_dir="${outdir}/prefilter_${genusname}"
+  if [ -n "$prefilter" ]; then
+    prefilter_options=()
+    if [ "$has_pairs" == true ]; then
+      # Only pairs of genomes missing some ANI run are considered, the stored pairs are kept as they are
+      new_all="${outdir}/${genusname}_new.list"
+      {
+        printf '%s\n' "${!skani_new[@]}"
+        for frag_len in "${frag_lengths[@]}"; do
+          for k in "${kmers[@]}"; do
+            python3 "$parent_dir/phallett/src/pair_store.py" -dir "${outdir}/${genusname}" -genus "$genusname" -metric ani -algorithm "$fragment_algorithm" -kmer "$k" -fragment_length "$frag_len" -list "$outdir/${genusname}.list"
+          done
+        done
+      } | grep -v '^$' | sort -u > "$new_all"
+      prefilter_options=(-new "$new_all")
+    fi
+    python3 "$parent_dir/phallett/src/ani_prefilter.py" -genus "$genusname" -list "$outdir/${genusname}.list" -outdir "$outdir" \
+      -max_distance "$prefilter" -ani_kmers "${kmers[*]}" -fragment_lengths "${frag_lengths[*]}" -ani_algorithm "$fragment_algorithm" -store "$parent_dir/phallett/data/Sketch_Store" "${prefilter_options[@]}"
+    rm -f "${outdir}/${genusname}_new.list"
+    while IFS=$'\t' read -r query reference; do
+      allowed["$query|$reference"]=1
+    done < "${prefilter_dir}/pairs.tsv"
+    # Stored skipped pairs allowed by this max_distance are compared again
+    while read -r genome; do
+      skani_new["$genome"]=1
+    done < "${prefilter_dir}/reopened.list"
+  fi
+
   output_file="${outdir}/skani_distance_${genusname}.txt"
   echo -e "Ref_file\tQuery_file\tANI\tAlign_fraction_ref\tAlign_fraction_query\tRef_name\tQuery_name" > "$output_file"
   
@@ -65,6 +125,14 @@ for subdir in "${subdirs[@]}"; do
     for j in "${!fasta_files[@]}"; do
       fasta2="${fasta_files[$j]}"
 
+      # Pairs between two genomes with stored pairs are already in the table
+      if [ -z "${skani_new[$fasta1]}" ] && [ -z "${skani_new[$fasta2]}" ]; then
+        continue
+      fi
+      if [ -n "$prefilter" ] && [ -z "${allowed[$fasta1|$fasta2]}" ]; then
+        continue
+      fi
+
       echo "Comparing $fasta1 with $fasta2"
       skani dist "$fasta1" "$fasta2" | tail -n +2 >> "$output_file"
       skani dist "$fasta2" "$fasta1" | tail -n +2 >> "$output_file"
@@ -75,18 +143,91 @@ for subdir in "${subdirs[@]}"; do
   awk '!seen[$0]++' "$output_file" > "${output_file}.tmp"
   mv "${output_file}.tmp" "$output_file"
 
-  mv *.txt "$outdir"
+  if [ "$engine" == "native" ]; then
+    # One index per genome and k shared by every fragment length, native_ani_<genus>_frag_<len>_<k> files as output
+    kmers_csv=$(IFS=,; echo "${kmers[*]}")
+    frags_csv=$(IFS=,; echo "${frag_lengths[*]}")
+    native_options=()
+    if [ -n "$prefilter" ]; then
+      native_options=(--pairs "${prefilter_dir}/pairs.tsv")
+    fi
+    python3 "$parent_dir/phallett/src/fragment_ani.py" -k "$kmers_csv" -f "$frags_csv" -g "$genusname" --source "$source" --outdir "$outdir" "${native_options[@]}" || failed=true
+    rm -rf "$prefilter_dir"
+    continue
+  fi
   
 for frag_len in "${frag_lengths[@]}"; do
     for k in "${kmers[@]}"; do
        #average_nucleotide_identity.py -i "${subdir_basename}.list" -o "${subdir}/fastani_${subdir_basename}_frag_${frag_len}_${k}" --method ANIb
-      fastANI --ql "$outdir/${genusname}.list" --rl "$outdir/${genusname}.list" -o "${outdir}/fastani_${genusname}_frag_${frag_len}_${k}" --fragLen "${frag_len}" --kmer "${k}"
+      fastani_out="${outdir}/fastani_${genusname}_frag_${frag_len}_${k}"
+      new_list=""
+      if [ "$has_pairs" == true ]; then
+        # Only new x all and all x new, fastANI is not symmetric
+        new_list="${outdir}/${genusname}_new_${k}.list"
+        python3 "$parent_dir/phallett/src/pair_store.py" -dir "${outdir}/${genusname}" -genus "$genusname" -metric ani -algorithm fastani -kmer "$k" -fragment_length "$frag_len" -list "$outdir/${genusname}.list" > "$new_list"
+        if [ -n "$prefilter" ]; then
+          cat "${prefilter_dir}/reopened.list" >> "$new_list"
+        fi
+        if [ ! -s "$new_list" ]; then
+          echo "All fastani pairs of $genusname with kmer $k and fragment length $frag_len are already stored"
+          rm -f "$new_list" "$fastani_out"
+          continue
+        fi
+      fi
+      fastani_failed=false
+      if [ -n "$prefilter" ]; then
+        # One fastANI call per group of queries sharing their prefiltered references
+        rm -f "$fastani_out"
+        while IFS=$'\t' read -r ql rl; do
+          qls=("$ql")
+          rls=("$rl")
+          if [ -n "$new_list" ]; then
+            # New queries against all their references, stored queries only against the new genomes
+            grep -Fx -f "$new_list" "$ql" > "${ql}.new"
+            grep -Fxv -f "$new_list" "$ql" > "${ql}.stored"
+            grep -Fx -f "$new_list" "$rl" > "${rl}.new"
+            qls=("${ql}.new" "${ql}.stored")
+            rls=("$rl" "${rl}.new")
+          fi
+          for i in "${!qls[@]}"; do
+            if [ ! -s "${qls[$i]}" ] || [ ! -s "${rls[$i]}" ]; then
+              continue
+            fi
+            if fastANI --ql "${qls[$i]}" --rl "${rls[$i]}" -o "${fastani_out}.part" --fragLen "${frag_len}" --kmer "${k}"; then
+              cat "${fastani_out}.part" >> "$fastani_out"
+            else
+              fastani_failed=true
+            fi
+            rm -f "${fastani_out}.part"
+          done
+        done < "${prefilter_dir}/groups.tsv"
+        rm -f "${prefilter_dir}"/*.new "${prefilter_dir}"/*.stored "$new_list"
+        if [ "$fastani_failed" == false ]; then
+          touch "$fastani_out"
+        fi
+      elif [ "$has_pairs" == true ]; then
+        fastANI --ql "$new_list" --rl "$outdir/${genusname}.list" -o "$fastani_out" --fragLen "${frag_len}" --kmer "${k}" || fastani_failed=true
+        fastANI --ql "$outdir/${genusname}.list" --rl "$new_list" -o "${fastani_out}.rev" --fragLen "${frag_len}" --kmer "${k}" || fastani_failed=true
+        cat "${fastani_out}.rev" >> "$fastani_out"
+        rm -f "${fastani_out}.rev" "$new_list"
+      else
+        fastANI --ql "$outdir/${genusname}.list" --rl "$outdir/${genusname}.list" -o "$fastani_out" --fragLen "${frag_len}" --kmer "${k}" || fastani_failed=true
+      fi
+      if [ "$fastani_failed" == true ]; then
+        # A partial output would mark its genomes as stored, the missing pairs would never be computed
+        rm -f "$fastani_out"
+      fi
       if [ -f "${outdir}/fastani_${genusname}_frag_${frag_len}_${k}" ]; then
-        echo "Fastani was calculated for $subdir_basename with kmer $k and fragment length $frag_len"
+        echo "Fastani was calculated for $genusname with kmer $k and fragment length $frag_len"
       else
-        echo "Error: fastANI calculation failed for $subdir_basename with kmer $k and fragment length $frag_len"
+        echo "Error: fastANI calculation failed for $genusname with kmer $k and fragment length $frag_len"
+        failed=true
       fi
     done
   done
+  rm -rf "$prefilter_dir"
 done
 
+if [ "$failed" == true ]; then
+  exit 1
+fi
@@ -3,9 +3,12 @@
 # Default k-mer values
 kmers=(7 9 11 12 13)
 genus=""
+engine="mash"
+max_distance=""
+memory_mb=512
 
 # Parse command-line options
-while getopts "k:g:" opt; do
+while getopts "k:g:e:t:m:" opt; do
     case ${opt} in
         k )
             # Parse k-mers as a comma-separated string into an array
@@ -14,6 +17,18 @@ while getopts "k:g:" opt; do
         g )
             genus=${OPTARG}
             ;;
+        e )
+            # mash (CLI) or native (in-process MinHash engine, src/minhash.py)
+            engine=${OPTARG}
+            ;;
+        t )
+            # native engine: only keep pairs at this mash distance or closer
+            max_distance=${OPTARG}
+            ;;
+        m )
+            # native engine: memory budget (MB) of one comparison tile
+            memory_mb=${OPTARG}
+            ;;
         \? )
             echo "Invalid option: $OPTARG" 1>&2
             exit 1
@@ -47,6 +62,15 @@ for subdir in "${subdirs[@]}"; do
   cd "$subdir" || { echo "Failed to cd into $subdir"; exit 1; }
 
   # MASH ALGORITHM
+  if [ "$engine" == "native" ]; then
+    # Sketch every genome once for all k-mer sizes and write the mash_distance tables directly
+    kmers_csv=$(IFS=,; echo "${kmers[*]}")
+    native_options=(--memory_mb "$memory_mb")
+    if [ -n "$max_distance" ]; then
+      native_options+=(--max_distance "$max_distance")
+    fi
+    python3 "$parent_dir/phallett/src/minhash.py" -k "$kmers_csv" -g "$subdir_basename" --source "$source" --outdir "$outdir" --store "$parent_dir/phallett/data/Sketch_Store" "${native_options[@]}"
+  else
   # Create a sketch of all the sequences
   # Use 64-bit hashes and a sketch default of 1000
   for k in "${kmers[@]}"; do
@@ -68,6 +92,7 @@ for subdir in "${subdirs[@]}"; do
 
   mv sketch* $outdir
   mv *.tab $outdir
+  fi
 
   # Generate Sourmash signatures for each k-mer size
   for k in "${kmers[@]}"; do
@@ -7,9 +7,11 @@ kmersy=(7,9,11,12,13)
 kmersx=(12,11,10,9,8)
 my="mash"
 mx="ani"
+jobs=1 #genera processed in parallel
+format="csv" #csv or parquet (needs pyarrow)
 parent_dir=$(dirname "$PWD")
 
-while getopts "mx:kmersx:my:kmersy" option; do
+while getopts "mx:kmersx:my:kmersy:format:jobs:" option; do
     case $option in
         mx) #Handle the -mx flag with an argument
         mx=${OPTARG}
@@ -23,10 +25,16 @@ while getopts "mx:kmersx:my:kmersy" option; do
         kmersy) #Handle the -kmersy flag with an argument
         kmersy=${OPTARG}
         ;;
+        jobs) #Handle the -jobs flag with an argument
+        jobs=${OPTARG}
+        ;;
+        format) #Handle the -format flag with an argument
+        format=${OPTARG}
+        ;;
     esac
 done
 
-python3 "$parent_dir/phallett/src/05.wraggling.py" -mx "$mx" -kmersx "$kmersx" -my "$my" -kmersy "$kmersy" > Metrics_Wraggling.log 2>&1
+python3 "$parent_dir/phallett/src/05.wraggling.py" -mx "$mx" -kmersx "$kmersx" -my "$my" -kmersy "$kmersy" -jobs "$jobs" -format "$format" > Metrics_Wraggling.log 2>&1
 cat Metrics_Wraggling.log
 
 
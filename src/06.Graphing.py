@@ -1,137 +1,110 @@
 import os
-import glob
+import sys
+import numpy as np
 import pandas as pd
 import argparse
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from pathlib import Path
+from results_io import read_table
+from metrics_join import join_metrics, partitions, cell_values
+from genus_runner import run_genera
+from fragment_ani import ALGORITHM as NATIVE_ANI
+
+
+# ICTV demarcation thresholds on the x metric and their colors
+THRESHOLDS = [88.00, 94.00]
+THRESHOLD_COLORS = np.array(['red', 'orange', 'pink'])
+# Scatter layers with more points than this are rasterized at RASTER_DPI in auto mode
+RASTER_THRESHOLD = 20000
+RASTER_DPI = 200
+
+
+def metric_tools(metric):
+    # Define tools based on arguments
+    if metric == "mash":
+        return ["mash", "sourmash"]
+    elif metric == "ani":
+        return ["fastani", NATIVE_ANI, "skani"]
+    elif metric == "aai":
+        return ["comparem"]
+    elif metric == "viridic":
+        return ["viridic"]
+    elif metric == "vcontact2":
+        return ["vcontact2"]
+    return []
+
+
+def metric_columns(metric):
+    return ["GenomeA", "GenomeB", f"{metric}_distance", f"kmer_{metric}", f"algorithm_{metric}"]
 
-# Set working directory
-current_dir = Path.cwd()
-parent_dir = current_dir.parent
-workdir = os.path.expanduser((Path(parent_dir) / "phallett" / "test" / "Metrics_Results"))
-subdirectories = [os.path.join(workdir, name) for name in os.listdir(workdir) if os.path.isdir(os.path.join(workdir, name))]
-
-# Create the argument parser
-parser = argparse.ArgumentParser(description='Process some arguments.')
-
-# Add arguments
-parser.add_argument('-mx', type=str, help='The mx argument')
-parser.add_argument('-kmersx', type=str, help='The kmersx argument')
-parser.add_argument('-my', type=str, help='The my argument')
-parser.add_argument('-kmersy', type=str, help='The kmersy argument')
-
-# Parse the arguments
-args = parser.parse_args()
-
-# Access the arguments
-print(f'mx: {args.mx}, kmersx: {args.kmersx}, my: {args.my}, kmersy: {args.kmersy}')
-
-mx = args.mx
-my = args.my
-kmersx = [int(k) for k in args.kmersx.split(",")]
-kmersy = [int(k) for k in args.kmersy.split(",")]
-
-# Define tools based on arguments
-tool_my = []
-tool_mx = []
-
-if my == "mash":
-    tool_my = ["mash", "sourmash"]
-elif my == "ani":
-    tool_my = ["fastani", "skani"]
-elif my == "aai":
-    tool_my = ["comparem"]
-elif my == "viridic":
-    tool_my = ["viridic"]
-elif my == "vcontact2":
-    tool_my = ["vcontact2"]
-
-if mx == "mash":
-    tool_mx = ["mash", "sourmash"]
-elif mx == "ani":
-    tool_mx = ["fastani", "skani"]
-elif mx == "aai":
-    tool_mx = ["comparem"]
-elif mx == "viridic":
-    tool_mx = ["viridic"]
-elif mx == "vcontact2":
-    tool_mx = ["vcontact2"]
-
-# Initialize DataFrames
-mx_data = pd.DataFrame()
-my_data = pd.DataFrame()
-
-for genus in subdirectories:
-    os.chdir(genus)
-    genus_name = os.path.basename(genus)
-    genus_dir = os.path.join(workdir, genus_name)
-    summaries = glob.glob(os.path.join(genus_dir, "*metrics*.csv"))
 
-    # Load mx data
+def threshold_colors(x_values):
+    # <= 88 family, 88-94 genus, > 94 species, binned in one call
+    return THRESHOLD_COLORS[np.digitize(x_values, THRESHOLDS, right=True)]
+
+
+def draw_pairs(ax, x_values, y_values, plot_mode="auto", raster_threshold=RASTER_THRESHOLD):
+    # Vector points for small genera, above raster_threshold points the scatter layer is rasterized
+    # so the PDF size and render time do not grow with the number of pairs; hexbin draws densities
+    if plot_mode == "hexbin":
+        ax.hexbin(x_values, y_values, gridsize=60, bins='log', mincnt=1, cmap='viridis', linewidths=0, rasterized=True)
+        for threshold, color in zip(THRESHOLDS, THRESHOLD_COLORS):
+            ax.axvline(threshold, color=color, linewidth=0.8)
+        return
+    rasterized = plot_mode == "raster" or (plot_mode == "auto" and len(x_values) > raster_threshold)
+    ax.scatter(x_values, y_values, c=threshold_colors(x_values), alpha=0.5, s=1, rasterized=rasterized)
+
+
+def plot_genus(genus_name, workdir, mx, my, tool_mx, tool_my, plot_mode="auto", raster_threshold=RASTER_THRESHOLD):
+    genus_dir = os.path.join(workdir, genus_name)
+    # Load mx data, CSV or Parquet, only the columns used by the plots
     if mx in [mx, my]:
-        mx_files = [s for s in summaries if f"{mx}_metrics_" in s]
-        if mx_files:
-            mx_data = pd.read_csv(mx_files[0])
+        mx_data = read_table(genus_dir, f"{mx}_metrics", genus_name, columns=metric_columns(mx))
+        if mx_data is not None:
             print(f"mx_data for {genus_name} loaded:\n{mx_data.head()}")
         else:
+            mx_data = pd.DataFrame(columns=metric_columns(mx))
             print(f"No {mx} data for {genus_name}")
 
     # Load my data
     if my in [mx, my]:
-        my_files = [s for s in summaries if f"{my}_metrics_" in s]
-        if my_files:
-            my_data = pd.read_csv(my_files[0])
+        my_data = read_table(genus_dir, f"{my}_metrics", genus_name, columns=metric_columns(my))
+        if my_data is not None:
             print(f"{genus_name} {my} data loaded:\n{my_data.head()}")
         else:
+            my_data = pd.DataFrame(columns=metric_columns(my))
             print(f"No {my} data for {genus_name}")
 
+    # One inner join on the pair for the genus, every plot cell below is a pair of its columns
+    joined = join_metrics(mx_data, my_data, mx, my)
+    kmers_mx = partitions(mx_data, mx)
+    kmers_my = partitions(my_data, my)
+
     for algorithm_mx in tool_mx:
         for algorithm_my in tool_my:
-            df_subset_mx = mx_data[mx_data[f"algorithm_{mx}"] == algorithm_mx]
-            df_subset_my = my_data[my_data[f"algorithm_{my}"] == algorithm_my]
+            kmer_values_mx = kmers_mx.get(algorithm_mx, [])
+            kmer_values_my = kmers_my.get(algorithm_my, [])
 
-            # Check for empty DataFrames
-            if df_subset_mx.empty or df_subset_my.empty:
+            # Check for empty partitions
+            if not kmer_values_mx or not kmer_values_my:
                 print(f"Empty DataFrames for mx: {algorithm_mx} or my: {algorithm_my} in genus: {genus_name}.")
                 continue
 
-            kmer_values_mx = sorted(pd.unique(df_subset_mx[f"kmer_{mx}"]))
-            kmer_values_my = sorted(pd.unique(df_subset_my[f"kmer_{my}"]))
-
-            if not kmer_values_my or not kmer_values_mx:
-                print(f"No kmer values for {my} with algorithm {algorithm_my} in genus {genus_name}")
-                continue
-
             fig, axes = plt.subplots(len(kmer_values_mx), len(kmer_values_my), figsize=(13, 9), sharex=True)
             axes = axes.reshape(len(kmer_values_mx), len(kmer_values_my))
             fig.text(0.04, 0.04, algorithm_my, va='center', rotation='vertical', fontsize=9)
 
             for j, my_kmer in enumerate(kmer_values_my):
                 for i, mx_kmer in enumerate(kmer_values_mx):
-                    df_subset_mx_kmer = df_subset_mx[df_subset_mx[f"kmer_{mx}"] == mx_kmer]
-                    df_subset_my_kmer = df_subset_my[df_subset_my[f"kmer_{my}"] == my_kmer]
-
-                    merged_df = pd.merge(df_subset_mx_kmer, df_subset_my_kmer, on=["GenomeA", "GenomeB"], how="outer")
-                    merged_df.sort_values(by=[f"{mx}_distance", f"{my}_distance"], inplace=True)
-                    merged_df = merged_df.dropna()
-
-                    if not merged_df.empty:
-                        colors = []
-                        for x_value in merged_df[f"{mx}_distance"]:
-                            if x_value <= 88.00:
-                                colors.append('red')
-                            elif 88.00 < x_value <= 94.00:
-                                colors.append('orange')
-                            else:
-                                colors.append('pink')
+                    x_values, y_values = cell_values(joined, mx, algorithm_mx, mx_kmer, my, algorithm_my, my_kmer)
 
+                    if len(x_values):
                         ax = axes[i, j]
                         ax.set_title(f"{algorithm_mx} kmer: {kmer_values_mx[i]}", fontsize=9)
                         ax.tick_params(axis='both', which='major', labelsize=9)
 
-                        scatter = ax.scatter(merged_df[f"{mx}_distance"], merged_df[f"{my}_distance"],
-                                             c=colors, alpha=0.5, s=1)
+                        draw_pairs(ax, x_values, y_values, plot_mode, raster_threshold)
 
                         ax.set_ylabel(f"{algorithm_my} kmer: {kmer_values_my[j]}", rotation=90, ha='center', fontsize=10)
                         ax.yaxis.set_label_coords(-0.25, 0.5)
@@ -144,8 +117,51 @@ for genus in subdirectories:
             ]
             fig.legend(handles=handles, loc='upper right', bbox_to_anchor=(1.0, 1.0), fontsize=9, frameon=False)
 
-            pdf_filename = f"{genus_name}_{algorithm_mx}_{algorithm_my}.pdf"
+            pdf_filename = os.path.join(genus_dir, f"{genus_name}_{algorithm_mx}_{algorithm_my}.pdf")
             print(f"Saving PDF: {pdf_filename}")
             with PdfPages(pdf_filename) as pdf:
-                pdf.savefig(fig)
+                pdf.savefig(fig, dpi=RASTER_DPI)
                 plt.close(fig)
+
+
+def main():
+    # Create the argument parser
+    parser = argparse.ArgumentParser(description='Process some arguments.')
+
+    # Add arguments
+    parser.add_argument('-mx', type=str, help='The mx argument')
+    parser.add_argument('-kmersx', type=str, help='The kmersx argument')
+    parser.add_argument('-my', type=str, help='The my argument')
+    parser.add_argument('-kmersy', type=str, help='The kmersy argument')
+    parser.add_argument('-jobs', type=int, default=1, help='Genera plotted in parallel')
+    parser.add_argument('-workdir', type=str, help='Metrics_Results directory')
+    parser.add_argument('-genus', type=str, help='Comma separated genera, all genera by default')
+    parser.add_argument('-plot_mode', type=str, default="auto", choices=["auto", "vector", "raster", "hexbin"],
+                        help='auto rasterizes large scatter layers, hexbin draws pair densities')
+    parser.add_argument('-raster_threshold', type=int, default=RASTER_THRESHOLD, help='Points above which auto mode rasterizes')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Access the arguments
+    print(f'mx: {args.mx}, kmersx: {args.kmersx}, my: {args.my}, kmersy: {args.kmersy}')
+
+    # Set working directory
+    current_dir = Path.cwd()
+    parent_dir = current_dir.parent
+    workdir = args.workdir or os.path.expanduser((Path(parent_dir) / "phallett" / "test" / "Metrics_Results"))
+    subdirectories = [name for name in os.listdir(workdir) if os.path.isdir(os.path.join(workdir, name))]
+    if args.genus:
+        subdirectories = [d for d in subdirectories if d in args.genus.split(",")]
+
+    mx = args.mx
+    my = args.my
+
+    failed = run_genera(plot_genus, subdirectories, (workdir, mx, my, metric_tools(mx), metric_tools(my), args.plot_mode, args.raster_threshold),
+                        jobs=args.jobs, summary_path=os.path.join(workdir, "run_summary_graphing.tsv"))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,10 @@ kmersy=(7,9,11,12,13)
 kmersx=(12,11,10,9,8)
 my="mash"
 mx="ani"
+jobs=1 #genera processed in parallel
 parent_dir=$(dirname "$PWD")
 
-while getopts "mx:kmersx:my:kmersy" option; do
+while getopts "mx:kmersx:my:kmersy:jobs:" option; do
     case $option in
         mx) #Handle the -mx flag with an argument
         mx=${OPTARG}
@@ -23,8 +24,11 @@ while getopts "mx:kmersx:my:kmersy" option; do
         kmersy) #Handle the -kmersy flag with an argumentcd
         kmersy=${OPTARG}
         ;;
+        jobs) #Handle the -jobs flag with an argument
+        jobs=${OPTARG}
+        ;;
     esac
 done
 
-python3 "$parent_dir/phallett/src/06.Graphing.py" -mx "$mx" -kmersx "$kmersx" -my "$my" -kmersy "$kmersy" > Graphing.log 2>&1
+python3 "$parent_dir/phallett/src/06.Graphing.py" -mx "$mx" -kmersx "$kmersx" -my "$my" -kmersy "$kmersy" -jobs "$jobs" > Graphing.log 2>&1
 cat Graphing.log
@@ -3,7 +3,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns  
 from pathlib import Path
-from Bio import SeqIO
+from fasta_stats import open_stats_cache
 import argparse
 
 # Set the main directory
@@ -16,12 +16,8 @@ genus_names = []
 genome_sizes = []
 genus_file_counts = []
 
-# Function to calculate the genome size of a FASTA file
-def get_genome_size(fasta_file_path):
-    genome_size = 0
-    for record in SeqIO.parse(fasta_file_path, "fasta"):
-        genome_size += len(record.seq)
-    return genome_size
+# Genome sizes come from the shared FASTA stats cache, unchanged genomes are not read again
+stats_cache = open_stats_cache(Path(parent_dir) / "data")
 
 # Iterate through subdirectories
 for subdir in os.listdir(main_directory):
@@ -40,7 +36,7 @@ for subdir in os.listdir(main_directory):
     # Iterate through the FASTA files and calculate genome sizes
     for fasta_file in fasta_files:
         fasta_file_path = os.path.join(subdirectory, fasta_file)
-        genome_size = get_genome_size(fasta_file_path)
+        genome_size = stats_cache.get(fasta_file_path)["length"]
         genus_genome_sizes.append(genome_size)
     
     # Store the genus name and genome sizes
@@ -50,6 +46,8 @@ for subdir in os.listdir(main_directory):
     # Store the count of FASTA files for this genus
     genus_file_counts.extend([len(fasta_files)] * len(genus_genome_sizes))  # Repeat count for each genome size
 
+stats_cache.save()
+
 # Create a DataFrame with the collected data
 data = pd.DataFrame({
     "Genus": genus_names,
@@ -1,32 +1,38 @@
 import os
-import re
+import sys
+import argparse
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.linear_model import LinearRegression
 from pathlib import Path
-
-def alignment_skani(file_path, output_dir, subdir_name):
-    # Read the DataFrame from the file
-    df = pd.read_csv(file_path, sep='\t')  # Adjust the separator if necessary
-
-    # Display the first few rows of the DataFrame to check the column names
-    print(f"Processing file: {file_path}")
+from genus_runner import run_genera
+from results_io import read_table
+from fragment_ani import ALGORITHM as NATIVE_ANI
+
+def read_alignment(genus_dir, genus):
+    # ANI and alignment fraction of every stored pair of the genus (ani_metrics merges all runs, the raw
+    # tool outputs of an incremental run only hold its new pairs)
+    table = read_table(genus_dir, "ani_metrics", genus, columns=["GenomeA", "GenomeB", "ani_distance", "kmer_ani", "algorithm_ani"],
+                       optional=["fragment_length", "align_fraction"])
+    if table is None or "align_fraction" not in table.columns:
+        print(f"No ani_metrics table with alignment fractions for {genus}")
+        return None
+    # Pairs skipped by the ANI prefilter and rows stored before the alignment fraction was kept have none
+    return table.dropna(subset=["ani_distance", "align_fraction"])
+
+
+def alignment_skani(table, output_dir, subdir_name):
+    df = table[table['algorithm_ani'].astype(str) == 'skani']
+    df = df.rename(columns={'GenomeA': 'GenomaA', 'ani_distance': 'ANI', 'align_fraction': 'Align_fraction_query'}).copy()
+    print(f"Processing skani pairs of {subdir_name}")
     print(df.head())
-    print("Available columns:", df.columns.tolist())  # Print available columns for debugging
 
     # Check if the necessary columns exist
     required_columns = ['Align_fraction_query', 'ANI']
     missing_columns = [col for col in required_columns if col not in df.columns]
 
-    if not missing_columns:
-        # Rename columns
-        df.rename(columns={'Ref_file': 'GenomaA', 'Query_file': 'GenomeB'}, inplace=True)
-        
-        # Extract values before the last '/' and before the '.' for GenomaA and GenomeB
-        df['GenomaA'] = df['GenomaA'].apply(lambda x: os.path.basename(x).split('.')[0])
-        df['GenomeB'] = df['GenomeB'].apply(lambda x: os.path.basename(x).split('.')[0])
-
+    if not missing_columns and not df.empty:
         # Create a figure and axis object
         plt.figure(figsize=(10, 6))
         
@@ -73,42 +79,18 @@ def alignment_skani(file_path, output_dir, subdir_name):
     else:
         print(f"Required columns are missing. Missing columns: {missing_columns}")
 
-def alignment_fastani(directory):
+def alignment_fastani(table, directory, genus_subdir, algorithm='fastani'):
+    # One dataframe per (fragment length, kmer), AF is mapped / total fragments in %
+    # algorithm is fastani or the native engine, which has the same layout and its own output files
+    df = table[table['algorithm_ani'].astype(str) == algorithm]
+    df = df.rename(columns={'GenomeA': 'GenomaA', 'ani_distance': 'ANI', 'align_fraction': 'AF'})
     dataframes = {}
-    
-    # Loop through files in the directory
-    for filename in os.listdir(directory):
-        # Check if filename matches the new expected pattern
-        if filename.startswith('fastani_'):
-            # Adjust the regex pattern based on the filename structure
-            match = re.match(r'^fastani_(.*?)_frag_500_(\d+)', filename)
-            if match:
-                genus_subdir = match.group(1)
-                kmer_size = int(match.group(2))
-                
-                # Define the path to the file
-                file_path = os.path.join(directory, filename)
-                
-                # Read the file into a DataFrame with manual column names
-                try:
-                    # Load the DataFrame without headers, assign headers manually
-                    df = pd.read_csv(file_path, sep='\t', header=None, names=['GenomaA', 'GenomeB', 'ANI', 'mappings', 'total_fragments'])
-                    print(f"Read {filename} into DataFrame with shape {df.shape}")
-                except Exception as e:
-                    print(f"Error reading {filename}: {e}")
-                    continue
-
-                # Calculate AF and add as a new column
-                try:
-                    df['AF'] = (df['mappings'] / df['total_fragments']) * 100
-                    dataframes[kmer_size] = df
-                except Exception as e:
-                    print(f"Error calculating AF for {filename}: {e}")
-            else:
-                print(f"Filename does not match expected pattern: {filename}")
+    for (frag_len, kmer_size), group in df.groupby([df['fragment_length'].astype(int), df['kmer_ani'].astype(int)]):
+        print(f"{algorithm} fragment length {frag_len}, kmer {kmer_size}: {len(group)} pairs")
+        dataframes[(frag_len, kmer_size)] = group.copy()
 
     if not dataframes:
-        print("No valid fastani files found in the directory.")
+        print(f"No {algorithm} pairs with alignment fractions found.")
         return
 
     # Plot scatter plots and perform linear regression for each k-mer size
@@ -118,10 +100,10 @@ def alignment_fastani(directory):
     if num_plots == 1:
         axes = [axes]  # Ensure axes is iterable if only one plot
 
-    for idx, (kmer_size, df) in enumerate(dataframes.items()):
+    for idx, ((frag_len, kmer_size), df) in enumerate(sorted(dataframes.items())):
         ax = axes[idx]
         ax.scatter(df['ANI'], df['AF'], alpha=0.7)
-        ax.set_title(f'Scatter Plot of ANI vs AF for k-mer size {kmer_size} - {genus_subdir}')
+        ax.set_title(f'Scatter Plot of {algorithm} ANI vs AF for fragment length {frag_len}, k-mer size {kmer_size} - {genus_subdir}')
         ax.set_xlabel('ANI')
         ax.set_ylabel('AF')
         ax.grid(True)
@@ -135,18 +117,20 @@ def alignment_fastani(directory):
 
         # Add linear regression values to the DataFrame
         df['Linear_Regression'] = y_pred
-        df['algorithm'] = 'fastani'
+        df['algorithm'] = algorithm
         df['kmer'] = kmer_size
+        df['fragment_length'] = frag_len
 
         # Collect results
-        results.append(df[['GenomaA', 'GenomeB', 'ANI', 'AF', 'Linear_Regression', 'algorithm', 'kmer']])
+        results.append(df[['GenomaA', 'GenomeB', 'ANI', 'AF', 'Linear_Regression', 'algorithm', 'kmer', 'fragment_length']])
         
         # Plot the regression line
         ax.plot(df['ANI'], y_pred, color='red', linewidth=2, label='Linear Regression')
         ax.legend()
 
     # Save the grid of plots as a PDF
-    plot_pdf_path = os.path.join(directory, 'ANI_vs_AF_grid.pdf')
+    suffix = '' if algorithm == 'fastani' else f'_{algorithm}'
+    plot_pdf_path = os.path.join(directory, f'ANI_vs_AF_grid{suffix}.pdf')
     plt.tight_layout()
     plt.savefig(plot_pdf_path, format='pdf')
     plt.close()
@@ -155,17 +139,37 @@ def alignment_fastani(directory):
     # Concatenate all DataFrames and save to CSV
     if results:
         all_results = pd.concat(results)
-        output_csv_path = os.path.join(directory, 'alignment_fraction_fastani.csv')
+        output_csv_path = os.path.join(directory, f'alignment_fraction_{algorithm}.csv')
         all_results.to_csv(output_csv_path, index=False)
         print(f'Saved the alignment fraction DataFrame to {output_csv_path}')
     else:
-        print("No results to save for fastani.")
+        print(f"No results to save for {algorithm}.")
+
+def alignment_genus(genus, workdir):
+    genus_dir = os.path.join(workdir, genus)
+
+    # Ensure the output directory exists
+    output_dir = genus_dir
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    table = read_alignment(genus_dir, genus)
+    if table is None:
+        return
+    alignment_skani(table, output_dir, genus)
+    alignment_fastani(table, genus_dir, genus)
+    alignment_fastani(table, genus_dir, genus, NATIVE_ANI)
 
 def main():
+    parser = argparse.ArgumentParser(description='Alignment fraction against ANI for every genus.')
+    parser.add_argument('-jobs', type=int, default=1, help='Genera processed in parallel')
+    parser.add_argument('-workdir', type=str, help='Metrics_Results directory')
+    args = parser.parse_args()
+
     # Set paths
     current_dir = Path.cwd()
     parent_dir = current_dir.parent
-    workdir = parent_dir / "test" / "Metrics_Results"
+    workdir = Path(args.workdir) if args.workdir else parent_dir / "test" / "Metrics_Results"
 
     # Check if the directory exists
     print(f"Work directory: {workdir}")
@@ -175,23 +179,10 @@ def main():
     subdirectories = [d for d in os.listdir(workdir) if os.path.isdir(os.path.join(workdir, d))]
 
     # Process files in each subdirectory
-    for genus in subdirectories:
-        genus_dir = os.path.join(workdir, genus)
-
-        # Ensure the output directory exists
-        output_dir = genus_dir
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        # Process skani files
-        skani_file_path = os.path.join(genus_dir, f'skani_distance_{genus}.txt')
-        if os.path.isfile(skani_file_path):
-            alignment_skani(skani_file_path, output_dir, genus)
-        else:
-            print(f"Skani file {skani_file_path} does not exist.")
-
-        # Process fastani files
-        alignment_fastani(genus_dir)
+    failed = run_genera(alignment_genus, subdirectories, (str(workdir),), jobs=args.jobs,
+                        summary_path=os.path.join(workdir, "run_summary_alignment_fraction.tsv"))
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -4,5 +4,8 @@
 # Get the parent directory (one level up from the current working directory)
 parent_dir=$(dirname "$PWD")
 
+# Genera processed in parallel, first argument (default 1)
+jobs=${1:-1}
+
 # Run the Python script with the fixed parent directory path
-python3 "$parent_dir/src/alignment_fraction.py" 
+python3 "$parent_dir/src/alignment_fraction.py" -jobs "$jobs" 
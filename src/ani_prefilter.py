@@ -0,0 +1,206 @@
+import os
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from glob import glob
+from pathlib import Path
+from pair_store import genome_name, fragment_lengths
+from pair_keys import GenomeDictionary
+from results_io import read_table
+from metrics_ingest import normalize_genomes
+from minhash import DEFAULT_SKETCH_SIZE, sketch_genus, sketch_matrix, shared_hashes, mash_distance
+from sketch_store import SketchStore
+
+# Mash prefilter for the ANI stage (03.ANI_Metrics.sh -p).
+# Pairs of a genus further apart than max_distance carry no genus or species signal, so only the closer
+# pairs are sent to fastANI (queries grouped by their reference list) and skani (list of allowed pairs).
+# Distances come from the mash outputs the pipeline already has (raw mash_distance tables or the stored
+# mash_metrics), and the pairs still missing are taken from native MinHash sketches (kept in the sketch store).
+# The skipped pairs are written to ani_skipped_<genus>.tsv, which 05.wraggling adds to ani_metrics
+# as explicit rows without ANI. Stored skipped pairs that a larger max_distance now allows are
+# compared again, their genomes are listed in reopened.list for the incremental runs of 03.
+DEFAULT_MAX_DISTANCE = 0.3
+DEFAULT_KMER = 13
+DEFAULT_FRAGMENT_LENGTHS = [500]
+# Label of the fragment based ANI rows, fastani or the native engine (fragment_ani.ALGORITHM)
+DEFAULT_ANI_ALGORITHM = "fastani"
+SKIPPED_COLUMNS = ["GenomeA", "GenomeB", "mash_distance", "kmer_ani", "algorithm_ani", "fragment_length"]
+
+
+def known_distances(genus, outdir, k):
+    # Mash distances of the genus already computed for k, keyed by genome names
+    frames = []
+    for path in glob(os.path.join(outdir, f"mash_distance_{genus}_k{k}.tab")) + \
+            glob(os.path.join(outdir, genus, f"mash_distance_{genus}_k{k}.tab")):
+        data = pd.read_csv(path, header=None, sep="\t", usecols=[0, 1, 2], names=["GenomeA", "GenomeB", "mash_distance"])
+        data["GenomeA"] = normalize_genomes(data["GenomeA"])
+        data["GenomeB"] = normalize_genomes(data["GenomeB"])
+        frames.append(data)
+    stored = read_table(os.path.join(outdir, genus), "mash_metrics", genus)
+    if stored is not None:
+        stored = stored[(stored["algorithm_mash"].astype(str) == "mash") & (stored["kmer_mash"].astype(str) == str(k))]
+        frames.append(stored[["GenomeA", "GenomeB", "mash_distance"]])
+    if not frames:
+        return pd.DataFrame(columns=["GenomeA", "GenomeB", "mash_distance"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def distance_matrix(genome_paths, genus, outdir, k, store=None):
+    # n x n Mash distances of the genus, known ones first, the rest from native sketches
+    names = [genome_name(path) for path in genome_paths]
+    genomes = GenomeDictionary(names)
+    ids = genomes.ids(names)
+    n = len(names)
+    distances = np.full((n, n), np.nan)
+    np.fill_diagonal(distances, 0.0)
+    known = known_distances(genus, outdir, k)
+    if not known.empty:
+        position = np.full(len(genomes), -1)
+        position[ids] = np.arange(n)
+        a = genomes.ids(known["GenomeA"])
+        b = genomes.ids(known["GenomeB"])
+        inside = (a >= 0) & (b >= 0)
+        rows, columns = position[a[inside]], position[b[inside]]
+        values = known["mash_distance"].to_numpy(dtype=float)[inside]
+        distances[rows, columns] = values
+        distances[columns, rows] = values
+
+    missing = np.flatnonzero(np.isnan(distances).any(axis=1))
+    if len(missing):
+        print(f"{len(missing)} genomes of {genus} without mash distances for k {k}, sketched natively")
+        sketched, sketches, _ = sketch_genus(Path(genome_paths[0]).parent, [k], DEFAULT_SKETCH_SIZE, store)
+        order = pd.Index([genome_name(path) for path in sketched]).get_indexer(names)
+        matrix = sketch_matrix([sketches[k][i] for i in order], DEFAULT_SKETCH_SIZE)
+        for row in missing:
+            shared, union = shared_hashes(matrix, row, np.arange(n), DEFAULT_SKETCH_SIZE)
+            values = mash_distance(shared, union, k)
+            gaps = np.isnan(distances[row])
+            distances[row, gaps] = values[gaps]
+            distances[gaps, row] = values[gaps]
+    return distances
+
+
+def stored_ani(genus, outdir):
+    # Stored ani_metrics rows of the genus, the skipped ones have no ANI
+    table = read_table(os.path.join(outdir, genus), "ani_metrics", genus,
+                       columns=["GenomeA", "GenomeB", "ani_distance", "kmer_ani", "algorithm_ani"], optional=["fragment_length"])
+    if table is None:
+        return pd.DataFrame(columns=["GenomeA", "GenomeB", "ani_distance", "kmer_ani", "algorithm_ani"])
+    return table
+
+
+def pair_mask(table, names):
+    # n x n mask of the pairs of a table, in the order of names
+    index = pd.Index(names)
+    a = index.get_indexer(table["GenomeA"].astype(str))
+    b = index.get_indexer(table["GenomeB"].astype(str))
+    inside = (a >= 0) & (b >= 0)
+    mask = np.zeros((len(names), len(names)), dtype=bool)
+    mask[a[inside], b[inside]] = True
+    return mask
+
+
+def prefilter_genus(genome_paths, genus, outdir, max_distance=DEFAULT_MAX_DISTANCE, k=DEFAULT_KMER,
+                    ani_kmers=(), new_paths=None, store=None, ani_fragment_lengths=DEFAULT_FRAGMENT_LENGTHS,
+                    ani_algorithm=DEFAULT_ANI_ALGORITHM):
+    # Writes under outdir/prefilter_<genus> the query and reference lists of the fastANI calls
+    # (groups.tsv: ql, rl) and the allowed pairs (pairs.tsv), and the skipped pairs to
+    # outdir/ani_skipped_<genus>.tsv
+    genome_paths = list(genome_paths)
+    n = len(genome_paths)
+    distances = distance_matrix(genome_paths, genus, outdir, k, store)
+    names = [genome_name(path) for path in genome_paths]
+    stored = stored_ani(genus, outdir)
+    skipped_before = stored[stored["ani_distance"].isna()]
+    compared = np.ones((n, n), dtype=bool)
+    reopened = np.zeros((n, n), dtype=bool)
+    if new_paths is not None:
+        # Incremental runs only look at pairs involving a new genome, and at the stored skipped
+        # pairs now within max_distance
+        new = np.isin(genome_paths, list(new_paths))
+        reopened = pair_mask(skipped_before, names)
+        reopened = (reopened | reopened.T) & (distances <= max_distance)
+        compared = new[:, None] | new[None, :] | reopened
+    allowed = compared & (distances <= max_distance)
+    skipped = compared & ~allowed
+
+    prefilter_dir = Path(outdir) / f"prefilter_{genus}"
+    shutil.rmtree(prefilter_dir, ignore_errors=True)
+    prefilter_dir.mkdir(parents=True)
+    reopened_genomes = np.flatnonzero(reopened.any(axis=1))
+    (prefilter_dir / "reopened.list").write_text("".join(f"{genome_paths[i]}\n" for i in reopened_genomes))
+    # Queries with the same allowed references share one fastANI call (--ql, --rl), fastANI indexes
+    # the reference list once per call
+    groups = {}
+    paths = np.asarray(genome_paths, dtype=object)
+    for q in range(n):
+        if allowed[q].any():
+            groups.setdefault(allowed[q].tobytes(), []).append(q)
+    lists = []
+    for i, rows in enumerate(groups.values()):
+        ql, rl = prefilter_dir / f"group_{i}.ql", prefilter_dir / f"group_{i}.rl"
+        ql.write_text("\n".join(paths[rows]) + "\n")
+        rl.write_text("\n".join(paths[allowed[rows[0]]]) + "\n")
+        lists.append((str(ql), str(rl)))
+    pd.DataFrame(lists, columns=["ql", "rl"]).to_csv(prefilter_dir / "groups.tsv", sep="\t", header=False, index=False)
+    queries, references = np.nonzero(allowed)
+    pd.DataFrame({"query": paths[queries], "reference": paths[references]}).to_csv(
+        prefilter_dir / "pairs.tsv", sep="\t", header=False, index=False)
+
+    # Skipped pairs in both directions, one row per ANI algorithm, kmer and fragment length they were not
+    # computed for
+    queries, references = np.nonzero(skipped)
+    names = np.asarray(names, dtype=object)
+    pairs = pd.DataFrame({"GenomeA": names[queries], "GenomeB": names[references],
+                          "mash_distance": distances[queries, references].round(6)})
+    # fastani (or native) kmers as integers, like the rows read_fastani ingests
+    runs = [(ani_algorithm, int(kmer), int(length)) for kmer in ani_kmers for length in ani_fragment_lengths]
+    runs += [("skani", "static", np.nan)]
+    rows = pd.concat([pairs.assign(kmer_ani=kmer, algorithm_ani=algorithm, fragment_length=length)
+                      for algorithm, kmer, length in runs], ignore_index=True)
+    # A pair with a stored ANI for the run keeps it
+    keys = ["GenomeA", "GenomeB", "algorithm_ani", "kmer_ani"]
+    computed = stored[stored["ani_distance"].notna()]
+    computed = computed[keys].astype(str).assign(fragment_length=fragment_lengths(computed).to_numpy()).drop_duplicates()
+    if not computed.empty and not rows.empty:
+        labels = rows[keys].astype(str).assign(fragment_length=fragment_lengths(rows).to_numpy())
+        found = labels.merge(computed, how="left", indicator=True)["_merge"] == "both"
+        rows = rows[~found.to_numpy()]
+    rows[SKIPPED_COLUMNS].to_csv(os.path.join(outdir, f"ani_skipped_{genus}.tsv"), sep="\t", index=False)
+
+    total = int(compared.sum() - np.diag(compared).sum())
+    print(f"{genus}: {int(skipped.sum())} of {total} pairs over mash distance {max_distance} skipped for ANI")
+    if len(reopened_genomes):
+        print(f"{genus}: {int(reopened.sum())} stored skipped pairs within {max_distance} compared again")
+    return lists
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mash prefilter of the genome pairs sent to fastANI and skani.')
+    parser.add_argument('-genus', type=str, required=True, help='Genus name')
+    parser.add_argument('-list', type=str, required=True, help='File with one genome path per line')
+    parser.add_argument('-new', type=str, help='File with the new genomes, only their pairs are considered')
+    parser.add_argument('-outdir', type=str, required=True, help='Metrics_Results directory')
+    parser.add_argument('-max_distance', type=float, default=DEFAULT_MAX_DISTANCE, help='Pairs over this mash distance are skipped')
+    parser.add_argument('-kmer', type=int, default=DEFAULT_KMER, help='Mash kmer used for the distances')
+    parser.add_argument('-ani_kmers', type=str, default="", help='fastANI kmers, recorded for the skipped pairs')
+    parser.add_argument('-fragment_lengths', type=str, default=",".join(map(str, DEFAULT_FRAGMENT_LENGTHS)),
+                        help='fastANI fragment lengths, recorded for the skipped pairs')
+    parser.add_argument('-ani_algorithm', type=str, default=DEFAULT_ANI_ALGORITHM, help='Algorithm label of the kmer runs, fastani or native_ani')
+    parser.add_argument('-store', type=str, help='Sketch store directory')
+    args = parser.parse_args()
+
+    genome_paths = [line.strip() for line in Path(args.list).read_text().splitlines() if line.strip()]
+    new_paths = None
+    if args.new:
+        new_paths = [line.strip() for line in Path(args.new).read_text().splitlines() if line.strip()]
+    store = SketchStore(args.store) if args.store else None
+    ani_kmers = [k for k in args.ani_kmers.replace(",", " ").split() if k]
+    ani_fragment_lengths = [f for f in args.fragment_lengths.replace(",", " ").split() if f]
+    prefilter_genus(genome_paths, args.genus, args.outdir, args.max_distance, args.kmer, ani_kmers, new_paths, store,
+                    ani_fragment_lengths, args.ani_algorithm)
+
+
+if __name__ == "__main__":
+    main()
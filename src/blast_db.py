@@ -0,0 +1,114 @@
+import csv
+import shutil
+import subprocess
+from pathlib import Path
+
+# Managed BLAST database for data/ICTV_database.
+# Genomes are streamed into makeblastdb volumes (no combined FASTA on disk) and the volumes are
+# joined by an alias database. The manifest records which files each volume holds, so an unchanged
+# database is not rebuilt and new genomes are appended as an extra volume.
+DB_NAME = "ICTV_database"
+MANIFEST_COLUMNS = ["file", "size", "mtime_ns", "volume"]
+MAX_VOLUMES = 20
+
+
+def scan_fasta(database_dir):
+    files = {}
+    for file in Path(database_dir).glob("*.fasta"):
+        stat = file.stat()
+        if stat.st_size > 0:
+            files[file.name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    return files
+
+
+def load_manifest(manifest_path):
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, newline="") as handle:
+        return {row["file"]: {"size": int(row["size"]), "mtime_ns": int(row["mtime_ns"]), "volume": row["volume"]}
+                for row in csv.DictReader(handle, delimiter="\t")}
+
+
+def save_manifest(manifest, manifest_path):
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t")
+        writer.writerow(MANIFEST_COLUMNS)
+        for name in sorted(manifest):
+            entry = manifest[name]
+            writer.writerow([name, entry["size"], entry["mtime_ns"], entry["volume"]])
+    tmp_path.replace(manifest_path)
+
+
+def build_volume(fasta_files, volume_path):
+    # Stream the genomes into makeblastdb through stdin instead of concatenating them on disk
+    command = ["makeblastdb", "-in", "-", "-dbtype", "nucl", "-out", str(volume_path), "-title", volume_path.name]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for fasta_file in fasta_files:
+            with open(fasta_file, "rb") as handle:
+                shutil.copyfileobj(handle, process.stdin)
+            # Files without a trailing newline would glue the next header to the last sequence line
+            process.stdin.write(b"\n")
+    finally:
+        process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"makeblastdb failed for {volume_path}")
+
+
+def write_alias(db_dir, volumes):
+    command = ["blastdb_aliastool", "-dblist", " ".join(volumes), "-dbtype", "nucl",
+               "-out", DB_NAME, "-title", DB_NAME]
+    if subprocess.run(command, cwd=db_dir).returncode != 0:
+        raise RuntimeError(f"blastdb_aliastool failed in {db_dir}")
+
+
+def remove_volumes(db_dir):
+    for file in Path(db_dir).glob("vol_*"):
+        file.unlink()
+
+
+def ensure_blast_db(database_dir, db_dir):
+    # Bring the BLAST database in line with database_dir and return the path to pass to blastn -db
+    database_dir = Path(database_dir)
+    db_dir = Path(db_dir)
+    db_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = db_dir / "manifest.tsv"
+    db_path = db_dir / DB_NAME
+
+    current = scan_fasta(database_dir)
+    manifest = load_manifest(manifest_path)
+    volumes = sorted({entry["volume"] for entry in manifest.values()})
+
+    added = sorted(set(current) - set(manifest))
+    removed = sorted(set(manifest) - set(current))
+    changed = sorted(name for name in set(current) & set(manifest)
+                     if (current[name]["size"], current[name]["mtime_ns"])
+                     != (manifest[name]["size"], manifest[name]["mtime_ns"]))
+    alias_exists = (db_dir / f"{DB_NAME}.nal").exists()
+
+    if not added and not removed and not changed and alias_exists:
+        print(f"BLAST database is up to date ({len(current)} genomes)")
+        return db_path
+
+    if removed or changed or not alias_exists or len(volumes) >= MAX_VOLUMES:
+        # A removed or modified genome cannot be dropped from a volume, so rebuild from scratch
+        print(f"Rebuilding BLAST database: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+        remove_volumes(db_dir)
+        manifest = {}
+        volumes = []
+        to_build = sorted(current)
+    else:
+        print(f"Appending {len(added)} genomes to the BLAST database as a new volume")
+        to_build = added
+
+    if to_build:
+        volume = f"vol_{len(volumes):03d}"
+        build_volume([database_dir / name for name in to_build], db_dir / volume)
+        volumes.append(volume)
+        for name in to_build:
+            manifest[name] = dict(current[name], volume=volume)
+
+    write_alias(db_dir, volumes)
+    save_manifest(manifest, manifest_path)
+    return db_path
@@ -0,0 +1,194 @@
+import os
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from pair_store import genome_name
+from results_io import read_table, write_table
+from minhash import DEFAULT_SKETCH_SIZE, sketch_genus, sketch_matrix, shared_hashes, mash_distance
+from sketch_store import SketchStore
+
+# Greedy dereplication of a genus before the quadratic metric stages (03, 04).
+# Genomes are visited longest first and each one joins the closest representative within the
+# species-level Mash distance (1 - identity / 100), or becomes a new representative. Only the
+# representatives stay in Taxa_Selected/<genus>; the members are moved to Taxa_Members/<genus>
+# with clusters_<genus>.tsv (genome, representative, mash_distance), so the metric tables of the
+# representatives can be expanded back to every genome (-expand, pairs inside a cluster are marked
+# and left without metric values) and the genus restored (-restore).
+# On later runs the stored representatives are kept and only the new genomes are assigned.
+DEFAULT_IDENTITY = 95.0
+DEFAULT_KMER = 21
+CLUSTER_COLUMNS = ["genome", "representative", "mash_distance"]
+
+
+def clusters_path(members_dir, genus):
+    return Path(members_dir) / genus / f"clusters_{genus}.tsv"
+
+
+def read_clusters(members_dir, genus):
+    path = clusters_path(members_dir, genus)
+    if not path.exists():
+        return pd.DataFrame(columns=CLUSTER_COLUMNS)
+    return pd.read_csv(path, sep="\t", dtype={"genome": str, "representative": str})
+
+
+def greedy_clusters(genomes, sketches, lengths, k, max_distance, representatives=()):
+    # (genome, representative, distance) of every genome, the given representatives are kept as such
+    matrix = sketch_matrix(sketches, DEFAULT_SKETCH_SIZE)
+    names = [genome_name(genome) for genome in genomes]
+    kept = {name for name in representatives}
+    # Stored representatives first, then the rest from the longest genome down
+    order = sorted(range(len(genomes)), key=lambda i: (names[i] not in kept, -lengths[i], names[i]))
+    rep_rows = []
+    assigned = []
+    for row in order:
+        if rep_rows and names[row] not in kept:
+            shared, union = shared_hashes(matrix, row, np.array(rep_rows), DEFAULT_SKETCH_SIZE)
+            distances = mash_distance(shared, union, k)
+            closest = int(np.argmin(distances))
+            if distances[closest] <= max_distance:
+                assigned.append((names[row], names[rep_rows[closest]], round(float(distances[closest]), 6)))
+                continue
+        rep_rows.append(row)
+        assigned.append((names[row], names[row], 0.0))
+    return pd.DataFrame(assigned, columns=CLUSTER_COLUMNS)
+
+
+def dereplicate_genus(genus, source, members_dir, identity=DEFAULT_IDENTITY, k=DEFAULT_KMER, store=None):
+    genus_dir = Path(source) / genus
+    genomes, sketches, lengths = sketch_genus(genus_dir, [k], DEFAULT_SKETCH_SIZE, store)
+    if not genomes:
+        print(f"No fasta files found in {genus_dir}")
+        return None
+    stored = read_clusters(members_dir, genus)
+    representatives = set(stored.loc[stored["genome"] == stored["representative"], "genome"])
+    clusters = greedy_clusters(genomes, sketches[k], lengths, k, 1 - identity / 100, representatives)
+
+    # Members leave Taxa_Selected, stored members of a cluster stay as they were
+    target = Path(members_dir) / genus
+    target.mkdir(parents=True, exist_ok=True)
+    moved = clusters[clusters["genome"] != clusters["representative"]]
+    for genome in moved["genome"]:
+        shutil.move(str(genus_dir / f"{genome}.fasta"), str(target / f"{genome}.fasta"))
+    stored = stored[~stored["genome"].isin(clusters["genome"])]
+    clusters = pd.concat([stored, clusters], ignore_index=True).sort_values(["representative", "genome"])
+    clusters.to_csv(clusters_path(members_dir, genus), sep="\t", index=False)
+
+    n_representatives = int((clusters["genome"] == clusters["representative"]).sum())
+    print(f"{genus}: {len(clusters)} genomes in {n_representatives} clusters at {identity}% identity, "
+          f"{len(moved)} members moved to {target}")
+    return clusters
+
+
+def restore_genus(genus, source, members_dir):
+    # Move the members back into Taxa_Selected and drop the cluster table
+    target = Path(members_dir) / genus
+    if not target.exists():
+        print(f"{genus} has no dereplicated members")
+        return
+    fastas = sorted(target.glob("*.fasta"))
+    for fasta in fastas:
+        shutil.move(str(fasta), str(Path(source) / genus / fasta.name))
+    clusters_path(members_dir, genus).unlink(missing_ok=True)
+    print(f"{genus}: {len(fastas)} members restored to {Path(source) / genus}")
+
+
+def cluster_pairs(clusters, canonical=False):
+    # Pairs of genomes inside one cluster (both directions and self pairs unless canonical), with the
+    # Mash distance recorded between a member and its representative (NaN for two members)
+    members = clusters[["genome", "representative", "mash_distance"]]
+    pairs = members.merge(members, on="representative", suffixes=("A", "B"))
+    pairs = pairs.rename(columns={"genomeA": "GenomeA", "genomeB": "GenomeB"})
+    if canonical:
+        pairs = pairs[pairs["GenomeA"] < pairs["GenomeB"]]
+    distance = np.where(pairs["GenomeA"] == pairs["representative"], pairs["mash_distanceB"],
+                        np.where(pairs["GenomeB"] == pairs["representative"], pairs["mash_distanceA"], np.nan))
+    return pd.DataFrame({"GenomeA": pairs["GenomeA"].to_numpy(), "GenomeB": pairs["GenomeB"].to_numpy(),
+                         "RepresentativeA": pairs["representative"].to_numpy(),
+                         "RepresentativeB": pairs["representative"].to_numpy(),
+                         "cluster_mash_distance": distance})
+
+
+def expand_pairs(table, clusters, canonical=False):
+    # Pairs of representatives -> pairs of every member of both clusters, with the representatives
+    # the value comes from. Pairs inside one cluster were never measured: they get no metric value,
+    # expanded_from_cluster set and the Mash distance recorded by the clustering (member to
+    # representative). canonical tables (summary) have one row per pair with GenomeA < GenomeB and
+    # no self pairs; the other tables keep both directions and the self pairs of the representatives.
+    members = clusters[["genome", "representative"]]
+    expanded = table[table["GenomeA"].astype(str) != table["GenomeB"].astype(str)]
+    expanded = expanded.rename(columns={"GenomeA": "RepresentativeA", "GenomeB": "RepresentativeB"})
+    for side in ("A", "B"):
+        expanded[f"Representative{side}"] = expanded[f"Representative{side}"].astype(str)
+        expanded = expanded.merge(members.rename(columns={"genome": f"Genome{side}", "representative": f"Representative{side}"}),
+                                  on=f"Representative{side}", how="left")
+        # Genomes without a cluster (dereplication not run for them) stand for themselves
+        expanded[f"Genome{side}"] = expanded[f"Genome{side}"].fillna(expanded[f"Representative{side}"])
+    if canonical:
+        # Member names can sort the other way round than their representatives
+        swap = (expanded["GenomeA"] > expanded["GenomeB"]).to_numpy()
+        for a, b in (("GenomeA", "GenomeB"), ("RepresentativeA", "RepresentativeB"), ("SpeciesA", "SpeciesB")):
+            if a in expanded.columns:
+                expanded.loc[swap, [a, b]] = expanded.loc[swap, [b, a]].to_numpy()
+    expanded["expanded_from_cluster"] = False
+
+    intra = cluster_pairs(clusters, canonical)
+    self_rows = table[table["GenomeA"].astype(str) == table["GenomeB"].astype(str)]
+    if not self_rows.empty:
+        # Measured self pairs of the representatives are kept as they are
+        self_rows = self_rows.assign(RepresentativeA=self_rows["GenomeA"].astype(str),
+                                     RepresentativeB=self_rows["GenomeB"].astype(str), expanded_from_cluster=False)
+        intra = intra[(intra["GenomeA"] != intra["RepresentativeA"]) | (intra["GenomeB"] != intra["RepresentativeB"])]
+    # One row per pair and partition (algorithm, kmer) of a long table, no metric value
+    labels = [c for c in table.columns if c.startswith(("algorithm_", "kmer_"))]
+    if labels:
+        intra = intra.merge(table[labels].drop_duplicates(), how="cross")
+    intra["expanded_from_cluster"] = True
+
+    columns = ["GenomeA", "GenomeB"] + [c for c in table.columns if c not in ("GenomeA", "GenomeB")]
+    columns += ["RepresentativeA", "RepresentativeB", "expanded_from_cluster", "cluster_mash_distance"]
+    result = pd.concat([expanded, self_rows, intra], ignore_index=True)
+    return result.reindex(columns=columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Greedy dereplication of the genera before the metric stages.')
+    parser.add_argument('-genus', type=str, required=True, help='Comma separated genera')
+    parser.add_argument('-identity', type=float, default=DEFAULT_IDENTITY, help='Genomes within this identity (1 - mash distance) of a representative are clustered')
+    parser.add_argument('-kmer', type=int, default=DEFAULT_KMER, help='Mash kmer used for the distances')
+    parser.add_argument('-source', type=str, help='Taxa_Selected directory')
+    parser.add_argument('-members', type=str, help='Directory the cluster members are moved to, default data/Taxa_Members')
+    parser.add_argument('-workdir', type=str, help='Metrics_Results directory, used by -expand')
+    parser.add_argument('-store', type=str, help='Sketch store directory, default data/Sketch_Store')
+    parser.add_argument('-restore', action='store_true', help='Move the members back to Taxa_Selected')
+    parser.add_argument('-expand', type=str, help='Metric table (ani_metrics, mash_metrics, summary) written as <table>_expanded for every genome')
+    parser.add_argument('-format', type=str, default="csv", choices=["csv", "parquet"], help='Format of the expanded table')
+    args = parser.parse_args()
+
+    # Set paths
+    current_dir = Path.cwd()
+    parent_dir = current_dir.parent
+    source = args.source or os.path.expanduser((Path(parent_dir) / "phallett" / "data" / "Taxa_Selected"))
+    members_dir = args.members or os.path.expanduser((Path(parent_dir) / "phallett" / "data" / "Taxa_Members"))
+    workdir = args.workdir or os.path.expanduser((Path(parent_dir) / "phallett" / "test" / "Metrics_Results"))
+
+    for genus in args.genus.split(","):
+        if args.restore:
+            restore_genus(genus, source, members_dir)
+        elif args.expand:
+            table = read_table(os.path.join(workdir, genus), args.expand, genus)
+            if table is None:
+                print(f"No {args.expand} table for {genus}")
+                continue
+            # The summary has one row per pair (join_metrics), the metric tables both directions
+            expanded = expand_pairs(table, read_clusters(members_dir, genus), canonical=args.expand == "summary")
+            write_table(expanded, os.path.join(workdir, genus), f"{args.expand}_expanded", genus, args.format)
+            print(f"{args.expand}_{genus}: {len(table)} pairs expanded to {len(expanded)}")
+        else:
+            store = SketchStore(args.store or Path(parent_dir) / "phallett" / "data" / "Sketch_Store")
+            dereplicate_genus(genus, source, members_dir, args.identity, args.kmer, store)
+
+
+if __name__ == "__main__":
+    main()
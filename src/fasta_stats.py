@@ -0,0 +1,89 @@
+import os
+import csv
+import numpy as np
+from pathlib import Path
+
+# Streaming FASTA statistics (length, GC, N and contig counts) for the genome size stages.
+# The file is read in large binary blocks and residues are counted on NumPy views of them, no
+# record objects are built. Results are cached per file keyed by size and mtime, so unchanged
+# genomes are never read again by 02, 07 or later QC steps.
+STATS_COLUMNS = ["path", "size", "mtime_ns", "length", "gc", "n", "contigs"]
+BUFFER_SIZE = 1 << 20
+
+
+def scan_fasta(fasta_path, buffer_size=BUFFER_SIZE):
+    length = gc = n = contigs = 0
+    in_header = False
+    with open(fasta_path, "rb") as handle:
+        while True:
+            chunk = handle.read(buffer_size)
+            if not chunk:
+                break
+            while chunk:
+                if in_header:
+                    # Skip the rest of the header line, it may continue in the next block
+                    end = chunk.find(b"\n")
+                    if end == -1:
+                        break
+                    chunk = chunk[end + 1:]
+                    in_header = False
+                    continue
+                start = chunk.find(b">")
+                codes = np.frombuffer(chunk if start == -1 else chunk[:start], dtype=np.uint8)
+                # Whitespace and line breaks are the bytes <= 32, OR 0x20 folds letters to lower case
+                length += codes.size - np.count_nonzero(codes <= 32)
+                lower = codes | 0x20
+                gc += np.count_nonzero(lower == ord("g")) + np.count_nonzero(lower == ord("c"))
+                n += np.count_nonzero(lower == ord("n"))
+                if start == -1:
+                    break
+                contigs += 1
+                in_header = True
+                chunk = chunk[start + 1:]
+    return {"length": int(length), "gc": int(gc), "n": int(n), "contigs": contigs}
+
+
+def gc_content(stats):
+    # GC percentage over the called bases (Ns excluded)
+    called = stats["length"] - stats["n"]
+    return round(100 * stats["gc"] / called, 2) if called > 0 else 0.0
+
+
+class FastaStatsCache:
+    def __init__(self, cache_path):
+        self.cache_path = Path(cache_path)
+        self.entries = {}
+        self.dirty = False
+        if self.cache_path.exists():
+            with open(self.cache_path, newline="") as handle:
+                for row in csv.DictReader(handle, delimiter="\t"):
+                    self.entries[row["path"]] = {column: int(row[column]) for column in STATS_COLUMNS[1:]}
+
+    def get(self, fasta_path):
+        # Stats of the file, scanned again only when its size or mtime changed
+        key = os.path.abspath(fasta_path)
+        stat = os.stat(key)
+        entry = self.entries.get(key)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = dict(scan_fasta(key), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            self.entries[key] = entry
+            self.dirty = True
+        return {column: entry[column] for column in ("length", "gc", "n", "contigs")}
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", newline="") as handle:
+            writer = csv.writer(handle, delimiter="\t")
+            writer.writerow(STATS_COLUMNS)
+            for path in sorted(self.entries):
+                entry = self.entries[path]
+                writer.writerow([path] + [entry[column] for column in STATS_COLUMNS[1:]])
+        os.replace(tmp_path, self.cache_path)
+        self.dirty = False
+
+
+def open_stats_cache(data_dir):
+    return FastaStatsCache(Path(data_dir) / "fasta_stats.tsv")
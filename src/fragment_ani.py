@@ -0,0 +1,213 @@
+import os
+import argparse
+import numpy as np
+from pathlib import Path
+from minhash import PAD, read_contigs, canonical_kmer_hashes
+from pair_store import new_genomes
+from results_io import find_table
+
+# In-process ANI in the style of fastANI, built on NumPy.
+# Every genome is read and encoded once. For each k one positional k-mer index is built per genome
+# (sampled canonical hashes with their positions and strand) and used both as reference and as query.
+# The k-mer hits of a query against a reference are computed once and shared by every fragment length:
+# the query is cut into non-overlapping fragments, each fragment is placed on the reference diagonal
+# (per strand) holding most of its k-mers, and its identity is containment ** (1 / k) within that
+# window. Fragments with identity >= 80% are mapped, ANI is their mean identity, and the output has
+# the fastANI layout (query, reference, ANI, mapped fragments, total fragments) under its own file
+# prefix and algorithm label, so 05.wraggling stores it apart from the fastANI results. Values track
+# fastANI but are not identical to it.
+ALGORITHM = "native_ani"
+DEFAULT_KMERS = [12, 11, 10, 9, 8]
+DEFAULT_FRAGMENT_LENGTHS = [500]
+MIN_IDENTITY = 0.80
+# k-mers occurring more often than this in a reference are ignored as seeds (as fastANI/minimap do)
+MAX_OCCURRENCES = 64
+# Only k-mers whose hash falls in the lowest 1/scaled of the hash space are used as seeds, on both
+# sides, like the minimizer sampling of fastANI
+DEFAULT_SCALED = 4
+
+
+class KmerIndex:
+    def __init__(self, contigs, k, scaled=DEFAULT_SCALED):
+        # Positions run over the contigs one after the other, k-mers never span two contigs
+        hashes, forward = [], []
+        for codes in contigs:
+            contig_hashes, contig_forward = canonical_kmer_hashes(codes, k, positional=True)
+            hashes.append(contig_hashes)
+            forward.append(contig_forward)
+        hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+        forward = np.concatenate(forward) if forward else np.empty(0, dtype=bool)
+        keep = hashes != PAD
+        if scaled > 1:
+            keep &= hashes <= np.uint64((1 << 64) // scaled)
+        self.k = k
+        self.contig_lengths = np.array([len(codes) for codes in contigs], dtype=np.int64)
+        # Query side: seeds in position order
+        self.positions = np.flatnonzero(keep)
+        self.hashes = hashes[keep]
+        self.forward = forward[keep]
+        # Reference side: the same seeds sorted by hash
+        self.order = np.argsort(self.hashes, kind="stable")
+        self.sorted_hashes = self.hashes[self.order]
+
+    def fragments(self, fragment_length):
+        # Fragment of every seed (-1 outside a full fragment) and number of fragments
+        fragment_of = np.full(len(self.positions), -1, dtype=np.int64)
+        offset = 0
+        first = 0
+        for length in self.contig_lengths:
+            n_kmers = max(length - self.k + 1, 0)
+            n_fragments = length // fragment_length
+            lo, hi = np.searchsorted(self.positions, [offset, offset + n_kmers])
+            if n_fragments and hi > lo:
+                starts = self.positions[lo:hi] - offset
+                fragment = starts // fragment_length
+                # k-mers running past the end of their fragment are not counted
+                inside = (fragment < n_fragments) & (starts % fragment_length <= fragment_length - self.k)
+                fragment_of[lo:hi][inside] = fragment[inside] + first
+            offset += n_kmers
+            first += n_fragments
+        return fragment_of, first
+
+
+def kmer_hits(query, reference):
+    # (query seed, reference position, same strand) of every seed hit, repetitive seeds dropped
+    lo = np.searchsorted(reference.sorted_hashes, query.hashes, side="left")
+    hi = np.searchsorted(reference.sorted_hashes, query.hashes, side="right")
+    counts = hi - lo
+    repetitive = counts > MAX_OCCURRENCES
+    counts[repetitive] = 0
+    total = int(counts.sum())
+    seeds = np.repeat(np.arange(len(query.hashes)), counts)
+    ends = np.cumsum(counts)
+    index = reference.order[np.repeat(lo, counts) + np.arange(total) - np.repeat(ends - counts, counts)]
+    same_strand = query.forward[seeds] == reference.forward[index]
+    return seeds, reference.positions[index], same_strand, repetitive
+
+
+def fragment_identities(query, hits, fragment_of, n_fragments, fragment_length):
+    # Identity of every query fragment at its best reference window
+    seeds, reference_positions, same_strand, repetitive = hits
+    kmers = np.bincount(fragment_of[~repetitive & (fragment_of >= 0)], minlength=n_fragments)
+    best = np.zeros(n_fragments, dtype=np.int64)
+    fragments = fragment_of[seeds]
+    keep = fragments >= 0
+    fragments = fragments[keep]
+    seeds = seeds[keep]
+    positions = query.positions[seeds]
+    strand = same_strand[keep].astype(np.int64)
+    # Forward hits share r - q, reverse complement hits share r + q
+    diagonal = np.where(strand == 1, reference_positions[keep] - positions, reference_positions[keep] + positions)
+    diagonal += int(query.contig_lengths.sum()) + fragment_length
+    n_bins = (int(diagonal.max()) if len(diagonal) else 0) // fragment_length + 2
+    n_seeds = max(len(query.hashes), 1)
+    # Two binnings half a fragment apart, so a window split by a bin edge is still found whole
+    for shift in (0, fragment_length // 2):
+        window = ((fragments * 2 + strand) * n_bins + (diagonal + shift) // fragment_length)
+        # Each seed counts once per window (sorted runs, cheaper than np.unique on large arrays)
+        keys = np.sort(window * n_seeds + seeds)
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))] // n_seeds
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        counts = np.diff(np.append(starts, len(keys)))
+        np.maximum.at(best, keys[starts] // (2 * n_bins), counts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        identity = np.where(kmers > 0, (best / np.maximum(kmers, 1)) ** (1.0 / query.k), 0.0)
+    return identity
+
+
+def pair_ani(query, reference, fragments, fragment_lengths):
+    # {fragment length: (ANI, mapped fragments, total fragments)} from one set of k-mer hits
+    hits = kmer_hits(query, reference)
+    results = {}
+    for fragment_length in fragment_lengths:
+        fragment_of, n_fragments = fragments[fragment_length]
+        if n_fragments == 0:
+            continue
+        identity = fragment_identities(query, hits, fragment_of, n_fragments, fragment_length)
+        mapped = identity >= MIN_IDENTITY
+        if mapped.any():
+            results[fragment_length] = (100 * identity[mapped].mean(), int(mapped.sum()), n_fragments)
+    return results
+
+
+def run_genus(genus_dir, outdir, kmers, fragment_lengths, scaled=DEFAULT_SCALED, pairs=None):
+    # pairs: optional set of (query path, reference path), the only pairs compared (ani_prefilter, which
+    # already restricts them to the new and reopened pairs in incremental runs)
+    genus_name = Path(genus_dir).name
+    genomes = sorted(str(f) for f in Path(genus_dir).glob("*.fasta"))
+    if not genomes:
+        print(f"No fasta files found in {genus_dir}")
+        return
+    contigs = [read_contigs(genome) for genome in genomes]
+    metrics_dir = os.path.join(outdir, genus_name)
+    has_pairs = find_table(metrics_dir, "ani_metrics", genus_name) is not None
+
+    for k in kmers:
+        # Only new x all and all x new pairs when the genus already has stored native pairs
+        # With prefiltered pairs these are already the pairs to compute
+        rows = set(range(len(genomes)))
+        if has_pairs and pairs is None:
+            # Genomes missing pairs for any of the fragment lengths
+            new = set().union(*(new_genomes(genomes, metrics_dir, genus_name, "ani", ALGORITHM, k, length)
+                                for length in fragment_lengths))
+            if not new:
+                print(f"All {ALGORITHM} pairs of {genus_name} with kmer {k} are already stored")
+                continue
+            rows = {i for i, genome in enumerate(genomes) if genome in new}
+            print(f"{len(rows)} new genomes of {genus_name} compared against {len(genomes)} for kmer {k}")
+
+        indexes = [KmerIndex(genome_contigs, k, scaled) for genome_contigs in contigs]
+        fragments = [{length: index.fragments(length) for length in fragment_lengths} for index in indexes]
+        outputs = {length: open(os.path.join(outdir, f"{ALGORITHM}_{genus_name}_frag_{length}_{k}"), "w")
+                   for length in fragment_lengths}
+        try:
+            for q, query in enumerate(indexes):
+                for r, reference in enumerate(indexes):
+                    if q not in rows and r not in rows:
+                        continue
+                    if pairs is not None and (genomes[q], genomes[r]) not in pairs:
+                        continue
+                    for length, (ani, mapped, total) in pair_ani(query, reference, fragments[q], fragment_lengths).items():
+                        outputs[length].write(f"{genomes[q]}\t{genomes[r]}\t{ani:.4f}\t{mapped}\t{total}\n")
+        finally:
+            for handle in outputs.values():
+                handle.close()
+        print(f"Native ANI was calculated for {genus_name} with kmer {k} and fragment lengths "
+              f"{', '.join(map(str, fragment_lengths))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ANI with the native fragment mapping engine.')
+    parser.add_argument('-k', '--kmers', type=str, default=",".join(map(str, DEFAULT_KMERS)), help='Comma separated k-mer sizes')
+    parser.add_argument('-f', '--fragment_lengths', type=str, default=",".join(map(str, DEFAULT_FRAGMENT_LENGTHS)),
+                        help='Comma separated fragment lengths')
+    parser.add_argument('-s', '--scaled', type=int, default=DEFAULT_SCALED, help='Keep 1/scaled of the k-mers as seeds, 1 keeps all')
+    parser.add_argument('-g', '--genus', type=str, default="", help='Genus to process, all genera by default')
+    parser.add_argument('--pairs', type=str, help='Query and reference per line (ani_prefilter pairs.tsv), only these pairs are compared')
+    parser.add_argument('--source', type=str, help='Taxa_Selected directory')
+    parser.add_argument('--outdir', type=str, help='Metrics_Results directory')
+    args = parser.parse_args()
+
+    # Set paths
+    current_dir = Path.cwd()
+    parent_dir = current_dir.parent
+    source = Path(args.source) if args.source else Path(parent_dir) / "phallett" / "data" / "Taxa_Selected"
+    outdir = Path(args.outdir) if args.outdir else Path(parent_dir) / "phallett" / "test" / "Metrics_Results"
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    kmers = [int(k) for k in args.kmers.replace(" ", ",").split(",") if k]
+    fragment_lengths = [int(f) for f in args.fragment_lengths.replace(" ", ",").split(",") if f]
+    if any(k > 32 for k in kmers):
+        parser.error("k-mer sizes above 32 are not supported")
+    if any(f <= max(kmers) for f in fragment_lengths):
+        parser.error("fragment lengths must be longer than the k-mer sizes")
+    pairs = None
+    if args.pairs:
+        pairs = {tuple(line.split("\t")[:2]) for line in Path(args.pairs).read_text().splitlines() if line}
+    genera = [source / args.genus] if args.genus else sorted(d for d in source.iterdir() if d.is_dir())
+    for genus_dir in genera:
+        run_genus(genus_dir, outdir, kmers, fragment_lengths, args.scaled, pairs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import random
+import shutil
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# NCBI E-utilities endpoint, overridable so the engine can be pointed to a local stub server
+EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+ESUMMARY_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi"
+NCBI_EMAIL = "na.portilla10@uniandes.edu.co"
+
+# NCBI allows 3 requests per second without an API key and 10 with one
+DEFAULT_RPS = 3
+API_KEY_RPS = 10
+
+
+class RateLimiter:
+    # Spaces the start of every request so the pool never goes over the allowed rate
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def base_accession(accession):
+    # Remove the version suffix (AB008550.1 -> AB008550)
+    return accession.strip().split(".")[0]
+
+
+def split_fasta_records(text):
+    # Split a multi-record FASTA response into {accession_without_version: record_text}
+    records = {}
+    header = None
+    lines = []
+    for line in text.splitlines():
+        if line.startswith(">"):
+            if header is not None:
+                records[base_accession(header)] = "\n".join(lines) + "\n"
+            header = line[1:].split(" ", 1)[0]
+            lines = [line]
+        elif header is not None and line.strip():
+            lines.append(line)
+    if header is not None:
+        records[base_accession(header)] = "\n".join(lines) + "\n"
+    return records
+
+
+def efetch_batch(accessions, base_url=EFETCH_URL, email=NCBI_EMAIL, api_key=None, timeout=120):
+    # One efetch request for many comma-joined IDs, sent as POST as NCBI recommends for long ID lists
+    params = {
+        "db": "nucleotide",
+        "id": ",".join(accessions),
+        "rettype": "fasta",
+        "retmode": "text",
+        "tool": "phallett",
+        "email": email,
+    }
+    if api_key:
+        params["api_key"] = api_key
+    data = urllib.parse.urlencode(params).encode()
+    with urllib.request.urlopen(base_url, data=data, timeout=timeout) as handle:
+        return handle.read().decode()
+
+
+def esummary_batch(accessions, base_url=ESUMMARY_URL, email=NCBI_EMAIL, api_key=None, timeout=120):
+    # One esummary request (JSON) for many comma-joined accessions, sent as POST like efetch_batch
+    params = {
+        "db": "nucleotide",
+        "id": ",".join(accessions),
+        "retmode": "json",
+        "tool": "phallett",
+        "email": email,
+    }
+    if api_key:
+        params["api_key"] = api_key
+    data = urllib.parse.urlencode(params).encode()
+    with urllib.request.urlopen(base_url, data=data, timeout=timeout) as handle:
+        return handle.read().decode()
+
+
+def parse_accession_versions(text):
+    # esummary JSON -> {accession_without_version: version} from the AccessionVersion of every record
+    result = json.loads(text).get("result", {})
+    versions = {}
+    for uid in result.get("uids", []):
+        accession_version = result.get(uid, {}).get("accessionversion", "")
+        if "." in accession_version:
+            versions[base_accession(accession_version)] = accession_version.split(".", 1)[1]
+    return versions
+
+
+def fetch_with_backoff(accessions, limiter, max_retries=5, backoff=2.0, max_backoff=60.0, request=efetch_batch, **kwargs):
+    # Retry a batch with exponential backoff plus jitter, giving up after max_retries attempts
+    for attempt in range(max_retries + 1):
+        limiter.wait()
+        try:
+            return request(accessions, **kwargs)
+        except (urllib.error.URLError, OSError) as e:
+            if attempt == max_retries:
+                print(f"Giving up on batch of {len(accessions)} after {max_retries} retries: {e}")
+                raise
+            delay = min(max_backoff, backoff * (2 ** attempt)) * (1 + random.random() * 0.1)
+            print(f"Error: {e}. Retrying in {delay:.1f} s")
+            time.sleep(delay)
+
+
+def fetch_splitting(batch, limiter, max_retries=5, split_retries=1, **kwargs):
+    # A batch that still fails after its retries is split in half and each half fetched again (with
+    # split_retries), down to single accessions, so one bad accession does not fail the whole batch
+    # Returns the FASTA text fetched and the accessions that could not be fetched
+    try:
+        return fetch_with_backoff(batch, limiter, max_retries=max_retries, **kwargs), []
+    except (urllib.error.URLError, OSError):
+        if len(batch) == 1:
+            print(f"Could not fetch {batch[0]}")
+            return "", list(batch)
+    middle = len(batch) // 2
+    texts, failed = [], []
+    for half in (batch[:middle], batch[middle:]):
+        text, half_failed = fetch_splitting(half, limiter, max_retries=split_retries, split_retries=split_retries, **kwargs)
+        texts.append(text)
+        failed.extend(half_failed)
+    print(f"Batch of {len(batch)} fetched in halves, {len(failed)} accessions failed")
+    return "\n".join(texts), failed
+
+
+def fetch_genomes(accessions, output_dir, store=None, batch_size=100, max_workers=3, requests_per_second=None,
+                  max_retries=5, backoff=2.0, base_url=EFETCH_URL, email=NCBI_EMAIL, api_key=None):
+    # Download accessions in batches on a bounded thread pool and write one <accession>.fasta per record
+    # With a GenomeStore, genomes already stored are linked into output_dir and only the rest are fetched
+    # Returns the list of written files and the list of accessions that could not be fetched
+    api_key = api_key or os.environ.get("NCBI_API_KEY")
+    if requests_per_second is None:
+        requests_per_second = API_KEY_RPS if api_key else DEFAULT_RPS
+    limiter = RateLimiter(requests_per_second)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Keep the requested name for each accession, so files match the names used in the VMR
+    requested = {}
+    for accession in accessions:
+        accession = str(accession).strip()
+        if accession:
+            requested.setdefault(base_accession(accession), accession)
+    downloaded = []
+    pending = []
+    for accession in requested.values():
+        if store is not None and accession in store:
+            downloaded.append(store.link(accession, os.path.join(output_dir, f"{accession}.fasta")))
+        else:
+            pending.append(accession)
+    if store is not None:
+        print(f"{len(downloaded)} genomes found in the genome store, {len(pending)} to download")
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch_splitting, batch, limiter, max_retries=max_retries, backoff=backoff,
+                            base_url=base_url, email=email, api_key=api_key): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                text, batch_failed = future.result()
+                records = split_fasta_records(text)
+            except Exception:
+                failed.extend(batch)
+                continue
+
+            failed.extend(batch_failed)
+            for accession in batch:
+                if accession in batch_failed:
+                    continue
+                record = records.get(base_accession(accession))
+                if record is None:
+                    print(f"No record returned for {accession}")
+                    failed.append(accession)
+                    continue
+                file_path = os.path.join(output_dir, f"{accession}.fasta")
+                if store is not None:
+                    store.add_text(accession, record)
+                    store.link(accession, file_path)
+                else:
+                    # Never write through an existing link into the genome store
+                    if os.path.lexists(file_path):
+                        os.remove(file_path)
+                    with open(file_path, "w") as file:
+                        file.write(record)
+                downloaded.append(file_path)
+            print(f"Downloaded {len(downloaded)}/{len(requested)} genomes")
+
+    if store is not None:
+        store.save()
+    return downloaded, failed
+
+
+def fetch_records(records, output_dir, store=None, **kwargs):
+    # Download genomes given as lists of accessions (the segments of one VMR row) and write one
+    # <first accession>.fasta per genome, the segments concatenated in order
+    # Returns the list of written files and the first accession of the genomes that could not be fetched
+    records = [[str(a).strip() for a in record if str(a).strip()] for record in records]
+    records = [record for record in records if record]
+    single = [record[0] for record in records if len(record) == 1]
+    segmented = [record for record in records if len(record) > 1]
+    downloaded, failed = fetch_genomes(single, output_dir, store=store, **kwargs) if single else ([], [])
+    if not segmented:
+        return downloaded, failed
+
+    # Segments are fetched (or linked from the store) one per file, then joined into the genome file
+    segments_dir = os.path.join(output_dir, f".segments_{os.getpid()}")
+    try:
+        _, failed_segments = fetch_genomes([a for record in segmented for a in record], segments_dir, store=store, **kwargs)
+        failed_segments = {base_accession(a) for a in failed_segments}
+        written = 0
+        for record in segmented:
+            missing = [a for a in record if base_accession(a) in failed_segments]
+            if missing:
+                print(f"Genome {record[0]} is missing the segments {', '.join(missing)}")
+                failed.append(record[0])
+                continue
+            file_path = os.path.join(output_dir, f"{record[0]}.fasta")
+            # Never write through an existing link into the genome store
+            if os.path.lexists(file_path):
+                os.remove(file_path)
+            with open(file_path, "w") as file:
+                for accession in record:
+                    with open(os.path.join(segments_dir, f"{accession}.fasta")) as segment:
+                        file.write(segment.read())
+            # Segment files left by runs that stored one file per segment
+            for accession in record[1:]:
+                segment_path = os.path.join(output_dir, f"{accession}.fasta")
+                if os.path.lexists(segment_path):
+                    os.remove(segment_path)
+            downloaded.append(file_path)
+            written += 1
+    finally:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+    print(f"{written} of {len(segmented)} segmented genomes written as one file each")
+    return downloaded, failed
+
+
+def fetch_versions(accessions, batch_size=200, max_workers=3, requests_per_second=None, max_retries=5, backoff=2.0,
+                   base_url=ESUMMARY_URL, email=NCBI_EMAIL, api_key=None):
+    # Current NCBI version of every accession, {accession_without_version: version}
+    # Accessions of failed batches or without a record are left out
+    api_key = api_key or os.environ.get("NCBI_API_KEY")
+    if requests_per_second is None:
+        requests_per_second = API_KEY_RPS if api_key else DEFAULT_RPS
+    limiter = RateLimiter(requests_per_second)
+    accessions = sorted({base_accession(str(a)) for a in accessions if str(a).strip()})
+    batches = [accessions[i:i + batch_size] for i in range(0, len(accessions), batch_size)]
+
+    versions = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_with_backoff, batch, limiter, max_retries=max_retries, backoff=backoff,
+                                   request=esummary_batch, base_url=base_url, email=email, api_key=api_key)
+                   for batch in batches]
+        for future in as_completed(futures):
+            try:
+                versions.update(parse_accession_versions(future.result()))
+            except Exception as e:
+                print(f"Version lookup of a batch failed: {e}")
+    return versions
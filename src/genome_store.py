@@ -0,0 +1,166 @@
+import os
+import csv
+import fcntl
+import shutil
+import hashlib
+from pathlib import Path
+
+# On-disk genome store shared by the taxa and BLAST selection stages.
+# Every genome is kept once under objects/<sha256[:2]>/<sha256>.fasta and the manifest maps
+# accession and version to its checksum, so stages link files instead of downloading them again.
+# Stages of different genera share the store: save takes a lock on the manifest, reads it again and
+# adds the entries of this run, so concurrent runs keep each other's genomes.
+MANIFEST_COLUMNS = ["accession", "version", "sha256", "size"]
+
+
+def sha256_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fasta_version(path):
+    # Read the version from the first FASTA header (>AB008550.1 ... -> "1")
+    with open(path) as handle:
+        header = handle.readline()
+    if not header.startswith(">"):
+        return ""
+    accession = header[1:].split(" ", 1)[0].strip()
+    return accession.split(".", 1)[1] if "." in accession else ""
+
+
+def link_file(source, destination):
+    # Hardlink when possible, otherwise symlink, otherwise copy
+    destination = Path(destination)
+    if destination.exists() or destination.is_symlink():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+
+class GenomeStore:
+    def __init__(self, root):
+        self.root = Path(root)
+        self.objects = self.root / "objects"
+        self.manifest_path = self.root / "manifest.tsv"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.entries = self.read_manifest()
+        # Accessions added in this run, the ones save writes over the manifest on disk
+        self.added = set()
+
+    def read_manifest(self):
+        entries = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, newline="") as handle:
+                for row in csv.DictReader(handle, delimiter="\t"):
+                    row["size"] = int(row["size"])
+                    entries[row["accession"]] = row
+        return entries
+
+    def __contains__(self, accession):
+        return self.get(accession) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def object_path(self, sha256):
+        return self.objects / sha256[:2] / f"{sha256}.fasta"
+
+    def get(self, accession, version=None):
+        # Look an accession up by its base name; a versioned accession (X.2) or version requires that version
+        accession = str(accession).strip()
+        if version is None and "." in accession:
+            version = accession.split(".", 1)[1]
+        entry = self.entries.get(accession.split(".")[0])
+        if entry is None or (version and entry["version"] != str(version)):
+            return None
+        if not self.object_path(entry["sha256"]).exists():
+            return None
+        return entry
+
+    def path(self, accession):
+        entry = self.get(accession)
+        return self.object_path(entry["sha256"]) if entry else None
+
+    def add_file(self, accession, path, move=False):
+        # Store a FASTA file under its checksum; identical content is only kept once
+        accession = str(accession).strip().split(".")[0]
+        sha256 = sha256_file(path)
+        target = self.object_path(sha256)
+        if not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if move:
+                os.replace(path, target)
+            else:
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copyfile(path, target)
+        entry = {"accession": accession, "version": fasta_version(target), "sha256": sha256,
+                 "size": target.stat().st_size}
+        self.entries[accession] = entry
+        self.added.add(accession)
+        return entry
+
+    def add_text(self, accession, text):
+        tmp_path = self.objects / f".{str(accession).strip()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as handle:
+            handle.write(text)
+        try:
+            return self.add_file(accession, tmp_path, move=True)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def link(self, accession, destination):
+        source = self.path(accession)
+        if source is None:
+            raise KeyError(f"{accession} is not in the genome store")
+        link_file(source, destination)
+        return destination
+
+    def import_directory(self, directory):
+        # Register FASTA files already on disk (e.g. data/ICTV_database) without copying them
+        added = 0
+        for file in sorted(Path(directory).glob("*.fasta")):
+            if file.stem in self.entries or file.stat().st_size == 0:
+                continue
+            self.add_file(file.stem, file)
+            added += 1
+        if added:
+            print(f"Added {added} genomes from {directory} to the genome store")
+            self.save()
+        return added
+
+    def save(self):
+        with open(self.manifest_path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # The manifest as other runs left it, plus the genomes added by this run
+            entries = self.read_manifest()
+            entries.update({accession: self.entries[accession] for accession in self.added})
+            self.entries = entries
+            tmp_path = self.manifest_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "w", newline="") as handle:
+                writer = csv.DictWriter(handle, fieldnames=MANIFEST_COLUMNS, delimiter="\t")
+                writer.writeheader()
+                for accession in sorted(self.entries):
+                    writer.writerow(self.entries[accession])
+            os.replace(tmp_path, self.manifest_path)
+        self.added.clear()
+
+
+def open_store(data_dir):
+    # Open data/Genome_Store and seed it with the ICTV database the first time
+    data_dir = Path(data_dir)
+    store = GenomeStore(data_dir / "Genome_Store")
+    ictv_database = data_dir / "ICTV_database"
+    if ictv_database.is_dir():
+        store.import_directory(ictv_database)
+    return store
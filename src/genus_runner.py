@@ -0,0 +1,55 @@
+import csv
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Per-genus task runner shared by the wraggling, graphing and alignment fraction stages.
+# A task is a module level function called as task(genus_name, *args) with explicit paths (no os.chdir),
+# so genera can run in a process pool. A failing genus is reported and does not stop the others,
+# and the outcome of every genus is written to a run summary.
+SUMMARY_COLUMNS = ["genus", "status", "seconds", "error"]
+
+
+def run_task(task, genus, args):
+    start = time.time()
+    try:
+        task(genus, *args)
+        return genus, "ok", round(time.time() - start, 2), ""
+    except Exception as e:
+        traceback.print_exc()
+        return genus, "failed", round(time.time() - start, 2), f"{type(e).__name__}: {e}"
+
+
+def write_summary(results, summary_path):
+    with open(summary_path, "w", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t")
+        writer.writerow(SUMMARY_COLUMNS)
+        writer.writerows(sorted(results))
+
+
+def run_genera(task, genera, args=(), jobs=1, summary_path=None):
+    # Run task over the genera with up to jobs processes, returns the genera that failed
+    genera = sorted(genera)
+    results = []
+    if jobs <= 1 or len(genera) <= 1:
+        for genus in genera:
+            results.append(run_task(task, genus, args))
+            print(f"{genus}: {results[-1][1]} ({results[-1][2]} s)")
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(genera))) as executor:
+            futures = {executor.submit(run_task, task, genus, args): genus for genus in genera}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # The worker process itself died (e.g. killed for memory)
+                    results.append((futures[future], "failed", 0.0, f"{type(e).__name__}: {e}"))
+                print(f"{results[-1][0]}: {results[-1][1]} ({results[-1][2]} s)")
+
+    failed = [genus for genus, status, _, _ in results if status != "ok"]
+    print(f"{len(results) - len(failed)} of {len(results)} genera processed" + (f", failed: {', '.join(failed)}" if failed else ""))
+    if summary_path:
+        write_summary(results, summary_path)
+        print(f"Run summary written to {summary_path}")
+    return failed
+
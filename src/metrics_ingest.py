@@ -0,0 +1,117 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+from glob import glob
+
+# Ingestion of the raw tool outputs of one genus (fastANI, skani, mash, sourmash) into the long
+# format tables used by 05.wraggling: GenomeA, GenomeB, <metric>_distance, kmer_<metric>, algorithm_<metric>.
+# Every raw file is read once into a list and concatenated a single time per tool, genome names are
+# normalized afterwards on the whole column, so the cost grows linearly with the number of files.
+# ANI rows also keep the fragment length (fastANI and the native engine, empty for skani) and the
+# alignment fraction.
+ANI_EXTRA_COLUMNS = ["fragment_length", "align_fraction"]
+
+
+def normalize_genomes(names):
+    # /path/to/AB008550.fasta -> AB008550, on the whole column at once
+    return names.astype(str).str.rsplit("/", n=1).str[-1].str.removesuffix(".fasta")
+
+
+def long_table(frames, metric, algorithm, normalize=True, extra=()):
+    columns = ["GenomeA", "GenomeB", f"{metric}_distance", f"kmer_{metric}", f"algorithm_{metric}"] + list(extra)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    table = pd.concat(frames, ignore_index=True)
+    if normalize:
+        table["GenomeA"] = normalize_genomes(table["GenomeA"])
+        table["GenomeB"] = normalize_genomes(table["GenomeB"])
+    table[f"algorithm_{metric}"] = algorithm
+    return table[columns]
+
+
+def raw_files(genus_dir, pattern):
+    return sorted(f for f in glob(os.path.join(genus_dir, pattern)) if not f.endswith('.csv'))
+
+
+def read_fastani(genus_dir, algorithm="fastani"):
+    # <algorithm>_<genus>_frag_<len>_<k>[.rev]: query, reference, ANI, mapped fragments, total fragments
+    # fastani for the fastANI CLI, fragment_ani.ALGORITHM for the native engine (same layout)
+    # The fragment length is kept as a column (one pair per fragment length) with the alignment
+    # fraction, mapped / total fragments in %
+    frames = []
+    for file in raw_files(genus_dir, f"{algorithm}_*"):
+        match = re.search(r'_frag_(\d+)_(\d+)(\.\w+)?$', os.path.basename(file))
+        if match is None:
+            continue
+        data = pd.read_csv(file, header=None, sep='\t', usecols=[0, 1, 2, 3, 4],
+                           names=["GenomeA", "GenomeB", "ani_distance", "mapped", "total"])
+        data["align_fraction"] = 100 * data["mapped"] / data["total"]
+        frames.append(data.assign(kmer_ani=int(match.group(2)), fragment_length=int(match.group(1))))
+    return long_table(frames, "ani", algorithm, extra=ANI_EXTRA_COLUMNS)
+
+
+def read_skani(genus_dir):
+    # skani triangle/dist output, the first line is the header
+    frames = []
+    for file in raw_files(genus_dir, "skani*"):
+        data = pd.read_csv(file, header=None, sep='\t', skiprows=1, usecols=[0, 1, 2, 4],
+                           names=["GenomeA", "GenomeB", "ani_distance", "align_fraction"])
+        frames.append(data.assign(kmer_ani="static", fragment_length=np.nan))
+    return long_table(frames, "ani", "skani", extra=ANI_EXTRA_COLUMNS)
+
+
+def ani_skipped_files(genus_dir):
+    return raw_files(genus_dir, "ani_skipped_*.tsv")
+
+
+def read_ani_skipped(genus_dir):
+    # ani_skipped_<genus>.tsv (ani_prefilter): pairs not sent to the ANI tools, kept with a NaN ANI
+    # and the Mash distance they were skipped at
+    frames = [pd.read_csv(file, sep='\t', dtype={"kmer_ani": str}) for file in ani_skipped_files(genus_dir)]
+    columns = ["GenomeA", "GenomeB", "ani_distance", "kmer_ani", "algorithm_ani", "fragment_length", "skipped_mash_distance"]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    table = pd.concat(frames, ignore_index=True).rename(columns={"mash_distance": "skipped_mash_distance"})
+    table["ani_distance"] = np.nan
+    # fastani (and native) kmers as integers like read_fastani, skani keeps "static"
+    table["kmer_ani"] = table["kmer_ani"].map(lambda k: int(k) if k.isdigit() else k).astype(object)
+    return table[columns]
+
+
+def read_mash(genus_dir, kmers):
+    # mash_distance_<genus>_k<k>.tab: reference, query, distance, p-value, shared hashes
+    frames = []
+    for file in sorted(glob(os.path.join(genus_dir, "mash*.tab"))):
+        k = int(re.search(r'k(\d+)', file).group(1))
+        if k in kmers:
+            data = pd.read_csv(file, header=None, sep='\t', usecols=[0, 1, 2], names=["GenomeA", "GenomeB", "mash_distance"])
+            frames.append(data.assign(kmer_mash=k))
+    return long_table(frames, "mash", "mash")
+
+
+def matrix_to_long(matrix, names, value_name, similarity=False):
+    # Square pairwise matrix -> one row per pair of the upper triangle (diagonal excluded)
+    # Similarities are turned into distances as 1 - similarity, genome names are categorical codes
+    matrix = np.asarray(matrix, dtype=float)
+    codes, genomes = pd.factorize(pd.Index(names))
+    i, j = np.triu_indices(matrix.shape[0], k=1)
+    values = matrix[i, j]
+    return pd.DataFrame({
+        "GenomeA": pd.Categorical.from_codes(codes[i], categories=genomes),
+        "GenomeB": pd.Categorical.from_codes(codes[j], categories=genomes),
+        value_name: 1.0 - values if similarity else values
+    })
+
+
+def read_sourmash(genus_dir, kmers):
+    # sourmash compare --csv similarity matrices, one per k, headers are the FASTA record names
+    frames = []
+    for file in sorted(glob(os.path.join(genus_dir, "sourmash*.csv"))):
+        k_values = [int(match.group(1)) for match in re.finditer(r'k(\d+)', file)]
+        k = k_values[0] if k_values else None
+        if k in kmers:
+            data = pd.read_csv(file, sep=',')
+            genomes = data.columns.str.split('.', n=1).str[0]
+            frames.append(matrix_to_long(data.to_numpy(), genomes, "mash_distance", similarity=True).assign(kmer_mash=k))
+    return long_table(frames, "mash", "sourmash", normalize=False)
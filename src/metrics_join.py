@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from pair_keys import GenomeDictionary, table_pair_keys, pair_frame
+
+# Join of two metric tables of a genus (e.g. ani_metrics and mash_metrics) on the genome pair.
+# Each long table is partitioned once by (algorithm, kmer) with groupby and turned into one row per
+# pair with one distance column per partition, then the two are inner joined on the pair a single time.
+# A plot cell (algorithm_mx kmer i, algorithm_my kmer j) is two columns of the joined table, so no
+# table is scanned or merged again per cell and pairs are not repeated across kmer combinations.
+# Pairs are keyed by packed int64 ids of a genome dictionary of the genus: A-B and B-A are one pair
+# (the distance is the mean of both directions) and self comparisons are left out.
+PAIR_COLUMNS = ["GenomeA", "GenomeB"]
+
+
+def cell_column(metric, algorithm, kmer):
+    # ani_distance_fastani_k12
+    return f"{metric}_distance_{algorithm}_k{kmer}"
+
+
+def kmer_labels(data, metric):
+    # Kmers as strings: stored CSVs read them back as "12" (the column mixes them with "static"),
+    # fresh ingests as 12, and both have to fall in one partition
+    return data[f"kmer_{metric}"].astype(str)
+
+
+def kmer_order(kmer):
+    # Numeric kmers in numeric order, named ones ("static") after them
+    return (0, int(kmer), "") if kmer.isdigit() else (1, 0, kmer)
+
+
+def partitions(data, metric):
+    # {algorithm: sorted kmers} present in a long metric table
+    groups = kmer_labels(data, metric).groupby(data[f"algorithm_{metric}"].astype(str), sort=True).unique()
+    return {algorithm: sorted(kmers, key=kmer_order) for algorithm, kmers in groups.items()}
+
+
+def wide_pairs(data, metric, genomes):
+    # One row per pair key, one distance column per (algorithm, kmer) partition
+    keys, distinct = table_pair_keys(data, genomes)
+    data = data[distinct]
+    distances = data[f"{metric}_distance"].groupby(
+        [keys[distinct], data[f"algorithm_{metric}"].to_numpy(), kmer_labels(data, metric).to_numpy()], sort=False).mean()
+    wide = distances.unstack([1, 2])
+    wide.columns = [cell_column(metric, algorithm, kmer) for algorithm, kmer in wide.columns]
+    return wide
+
+
+def join_metrics(mx_data, my_data, mx, my, genomes=None):
+    # Pairs measured by both metrics, with every (algorithm, kmer) distance of each as a column
+    if mx_data.empty or my_data.empty:
+        return pd.DataFrame(columns=PAIR_COLUMNS)
+    if genomes is None:
+        genomes = GenomeDictionary.from_tables(mx_data, my_data)
+    joined = wide_pairs(mx_data, mx, genomes).join(wide_pairs(my_data, my, genomes), how="inner")
+    joined = joined.sort_index()
+    pairs = pair_frame(joined.index.to_numpy(), genomes)
+    return pd.concat([pairs, joined.reset_index(drop=True)], axis=1)
+
+
+def cell_values(joined, mx, algorithm_mx, kmer_mx, my, algorithm_my, kmer_my):
+    # x and y distances of the pairs measured in both partitions, sorted by x then y
+    x_column = cell_column(mx, algorithm_mx, kmer_mx)
+    y_column = cell_column(my, algorithm_my, kmer_my)
+    if x_column not in joined.columns or y_column not in joined.columns:
+        return np.empty(0), np.empty(0)
+    cell = joined[[x_column, y_column]].dropna()
+    x_values = cell[x_column].to_numpy(dtype=float)
+    y_values = cell[y_column].to_numpy(dtype=float)
+    order = np.lexsort((y_values, x_values))
+    return x_values[order], y_values[order]
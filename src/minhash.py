@@ -0,0 +1,269 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy.stats import binom
+from sketch_store import SketchStore, genome_fingerprint
+from pair_store import new_genomes
+from results_io import find_table
+
+# In-process MinHash (Mash-style bottom-k sketches) built on NumPy.
+# Every genome is read and encoded once, and canonical k-mers for all requested k are hashed from
+# that single encoding. Distances use the Mash formula, D = -1/k * ln(2j / (1 + j)), so they are
+# comparable to mash dist, but hashes differ from mash's MurmurHash so sketches are not interchangeable.
+# Pairs are compared in memory-bounded tiles and streamed to disk, so large families run in fixed RAM.
+PAD = np.uint64(np.iinfo(np.uint64).max)
+DEFAULT_SKETCH_SIZE = 1000
+ALGORITHM = "minhash"
+SEED = 42
+# Memory budget of one comparison tile, and bytes used per merged hash in a tile
+DEFAULT_MEMORY_MB = 512
+TILE_BYTES_PER_HASH = 20
+
+# A/C/G/T -> 0..3, everything else (N, IUPAC codes) -> 4 and breaks the k-mer
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b"ACGT", range(4)):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+
+def read_contigs(fasta_path):
+    # Encoded sequence of each record, k-mers never span two records
+    with open(fasta_path, "rb") as handle:
+        data = handle.read()
+    contigs = []
+    for record in data.split(b">")[1:]:
+        sequence = record.split(b"\n", 1)[1] if b"\n" in record else b""
+        sequence = sequence.translate(None, b"\r\n\t ")
+        if sequence:
+            contigs.append(BASE_CODES[np.frombuffer(sequence, dtype=np.uint8)])
+    return contigs
+
+
+def mix64(values, k):
+    # splitmix64 finalizer, the seed depends on k so every k-mer size gets its own hash family
+    with np.errstate(over="ignore"):
+        x = values ^ np.uint64((SEED * 0x9E3779B97F4A7C15 + k) & 0xFFFFFFFFFFFFFFFF)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def canonical_kmer_hashes(codes, k, positional=False):
+    # Hash of min(forward, reverse complement) for every valid k-mer of one encoded contig (k <= 32)
+    # With positional, one hash per start position (PAD where the k-mer holds an N) and whether the
+    # forward strand was the canonical one
+    n = len(codes) - k + 1
+    if n <= 0:
+        if positional:
+            return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+        return np.empty(0, dtype=np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (invalid[k:] - invalid[:-k]) == 0
+    values = np.where(codes == 4, 0, codes).astype(np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    for i in range(k):
+        window = values[i:i + n]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * i)
+    if positional:
+        hashes = mix64(np.minimum(forward, reverse), k)
+        hashes[~valid] = PAD
+        return hashes, forward <= reverse
+    return mix64(np.minimum(forward, reverse)[valid], k)
+
+
+def sketch_genome(fasta_path, kmers, sketch_size=DEFAULT_SKETCH_SIZE):
+    # Bottom-k sketch for every k from a single read of the genome
+    # Returns ({k: sorted uint64 hashes}, genome length)
+    contigs = read_contigs(fasta_path)
+    length = int(sum(len(c) for c in contigs))
+    sketches = {}
+    for k in kmers:
+        hashes = [canonical_kmer_hashes(c, k) for c in contigs]
+        hashes = np.unique(np.concatenate(hashes)) if hashes else np.empty(0, dtype=np.uint64)
+        sketches[k] = hashes[:sketch_size]
+    return sketches, length
+
+
+def sketch_matrix(sketches, sketch_size):
+    # Stack sketches into an n x sketch_size array, short sketches padded with PAD
+    matrix = np.full((len(sketches), sketch_size), PAD, dtype=np.uint64)
+    for row, sketch in enumerate(sketches):
+        matrix[row, :len(sketch)] = sketch
+    return matrix
+
+
+def shared_hashes(matrix, row, others, sketch_size):
+    # Vectorized Mash comparison of one sketch against many: merge each pair of sketches, keep the
+    # bottom sketch_size distinct hashes of the union and count how many of those are in both
+    block = np.concatenate([np.broadcast_to(matrix[row], (len(others), matrix.shape[1])), matrix[others]], axis=1)
+    block.sort(axis=1)
+    valid = block != PAD
+    duplicate = np.zeros_like(valid)
+    duplicate[:, 1:] = (block[:, 1:] == block[:, :-1]) & valid[:, 1:]
+    distinct = valid & ~duplicate
+    in_union = np.cumsum(distinct, axis=1) <= sketch_size
+    shared = (duplicate & in_union).sum(axis=1)
+    union = np.minimum(distinct.sum(axis=1), sketch_size)
+    return shared, union
+
+
+def mash_distance(shared, union, k):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jaccard = np.where(union > 0, shared / np.maximum(union, 1), 0.0)
+        distance = -np.log(2 * jaccard / (1 + jaccard)) / k
+    return np.where(jaccard > 0, np.abs(distance), 1.0)
+
+
+def mash_pvalue(shared, union, k, length_a, length_b):
+    # Probability of sharing at least that many hashes by chance, as computed by mash dist
+    kmer_space = 4.0 ** k
+    p_a = 1.0 / (1.0 + kmer_space / np.maximum(length_a, 1))
+    p_b = 1.0 / (1.0 + kmer_space / np.maximum(length_b, 1))
+    r = p_a * p_b / (p_a + p_b - p_a * p_b)
+    return np.where(shared > 0, binom.sf(shared - 1, union, r), 1.0)
+
+
+def tile_columns(sketch_size, memory_mb):
+    # Genomes compared against one row per tile so the merged block (uint64 hashes, masks and the
+    # running count of 2 * sketch_size entries per genome) stays within memory_mb
+    bytes_per_column = 2 * sketch_size * TILE_BYTES_PER_HASH
+    return max(1, int(memory_mb * (1 << 20)) // bytes_per_column)
+
+
+def write_pairwise_distances(output_path, genomes, sketches, k, lengths, sketch_size=DEFAULT_SKETCH_SIZE,
+                             rows=None, max_distance=None, memory_mb=DEFAULT_MEMORY_MB):
+    # All-vs-all (or rows vs all) distances for the sketches of one k, in the `mash dist` layout:
+    # reference, query, distance, p-value, shared-hashes, both directions of every pair.
+    # Distances are computed in tiles of one row against a block of columns sized to memory_mb and
+    # each tile is written as soon as it is done, so no n x n matrix is ever held in memory.
+    # With max_distance only the pairs at that distance or closer are written. Returns the pairs written.
+    n = len(sketches)
+    matrix = sketch_matrix(sketches, sketch_size)
+    lengths = np.asarray(lengths, dtype=float)
+    names = np.asarray(genomes, dtype=object)
+    step = tile_columns(sketch_size, memory_mb)
+    selected = np.zeros(n, dtype=bool)
+    selected[list(range(n)) if rows is None else list(rows)] = True
+    written = 0
+    with open(output_path, "w") as handle:
+        for row in np.flatnonzero(selected):
+            # Each pair once: columns after the row, plus the unselected columns before it
+            others = np.concatenate([np.flatnonzero(~selected[:row]), np.arange(row, n)])
+            for start in range(0, len(others), step):
+                tile = others[start:start + step]
+                s, u = shared_hashes(matrix, row, tile, sketch_size)
+                d = mash_distance(s, u, k)
+                keep = np.ones(len(tile), dtype=bool) if max_distance is None else d <= max_distance
+                if not keep.any():
+                    continue
+                tile, s, u, d = tile[keep], s[keep], u[keep], d[keep]
+                p = mash_pvalue(s, u, k, lengths[row], lengths[tile])
+                # The diagonal is written once, every other pair in both directions
+                mirror = tile != row
+                reference = np.concatenate([np.full(len(tile), names[row], dtype=object), names[tile[mirror]]])
+                query = np.concatenate([names[tile], np.full(mirror.sum(), names[row], dtype=object)])
+                hashes = np.char.add(np.char.add(s.astype(str), "/"), u.astype(str))
+                pd.DataFrame({"reference": reference, "query": query,
+                              "distance": np.concatenate([d, d[mirror]]), "pvalue": np.concatenate([p, p[mirror]]),
+                              "shared": np.concatenate([hashes, hashes[mirror]])}
+                             ).to_csv(handle, sep="\t", header=False, index=False, float_format="%.7g")
+                written += len(tile) + int(mirror.sum())
+    return written
+
+
+def sketch_genus(genus_dir, kmers, sketch_size=DEFAULT_SKETCH_SIZE, store=None):
+    # With a SketchStore only the genomes (and k-mer sizes) missing from the index are sketched
+    genomes = sorted(str(f) for f in Path(genus_dir).glob("*.fasta"))
+    sketches = {k: [] for k in kmers}
+    lengths = []
+    computed = 0
+    for genome in genomes:
+        accession = Path(genome).stem
+        fingerprint = genome_fingerprint(genome) if store is not None else None
+        genome_sketches = {}
+        length = 0
+        if store is not None:
+            for k in kmers:
+                stored = store.get(accession, ALGORITHM, k, sketch_size, fingerprint)
+                if stored is not None:
+                    genome_sketches[k], length = stored
+        missing = [k for k in kmers if k not in genome_sketches]
+        if missing:
+            new_sketches, length = sketch_genome(genome, missing, sketch_size)
+            computed += 1
+            for k in missing:
+                genome_sketches[k] = new_sketches[k]
+                if store is not None:
+                    store.put(accession, ALGORITHM, k, sketch_size, fingerprint, length, new_sketches[k])
+        lengths.append(length)
+        for k in kmers:
+            sketches[k].append(genome_sketches[k])
+    if store is not None:
+        store.save()
+        print(f"{computed} of {len(genomes)} genomes sketched, the rest reused from the sketch store")
+    return genomes, sketches, lengths
+
+
+def run_genus(genus_dir, outdir, kmers, sketch_size=DEFAULT_SKETCH_SIZE, store=None, max_distance=None,
+              memory_mb=DEFAULT_MEMORY_MB):
+    genus_name = Path(genus_dir).name
+    genomes, sketches, lengths = sketch_genus(genus_dir, kmers, sketch_size, store)
+    if not genomes:
+        print(f"No fasta files found in {genus_dir}")
+        return
+    print(f"Sketched {len(genomes)} genomes of {genus_name} for k = {', '.join(map(str, kmers))}")
+    # When the genus already has stored mash pairs, only the genomes without pairs are compared
+    metrics_dir = os.path.join(outdir, genus_name)
+    has_pairs = find_table(metrics_dir, "mash_metrics", genus_name) is not None
+    for k in kmers:
+        output_path = os.path.join(outdir, f"mash_distance_{genus_name}_k{k}.tab")
+        rows = None
+        if has_pairs:
+            new = set(new_genomes(genomes, metrics_dir, genus_name, "mash", "mash", k))
+            if not new:
+                print(f"All mash pairs of {genus_name} with kmer {k} are already stored")
+                continue
+            rows = [i for i, genome in enumerate(genomes) if genome in new]
+            print(f"{len(rows)} new genomes of {genus_name} compared against {len(genomes)} for kmer {k}")
+        written = write_pairwise_distances(output_path, genomes, sketches[k], k, lengths, sketch_size, rows,
+                                           max_distance, memory_mb)
+        print(f"The matrix distance is calculated for {genus_name} with kmer {k} ({written} pairs written)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mash distances with the native MinHash engine.')
+    parser.add_argument('-k', '--kmers', type=str, default="7,9,11,12,13", help='Comma separated k-mer sizes')
+    parser.add_argument('-g', '--genus', type=str, default="", help='Genus to process, all genera by default')
+    parser.add_argument('-s', '--sketch_size', type=int, default=DEFAULT_SKETCH_SIZE, help='Sketch size')
+    parser.add_argument('--source', type=str, help='Taxa_Selected directory')
+    parser.add_argument('--outdir', type=str, help='Metrics_Results directory')
+    parser.add_argument('--store', type=str, help='Sketch store directory, default data/Sketch_Store')
+    parser.add_argument('--no_store', action='store_true', help='Sketch every genome again without the sketch store')
+    parser.add_argument('--max_distance', type=float, help='Only write pairs at this mash distance or closer')
+    parser.add_argument('--memory_mb', type=int, default=DEFAULT_MEMORY_MB, help='Memory budget of one comparison tile')
+    args = parser.parse_args()
+
+    # Set paths
+    current_dir = Path.cwd()
+    parent_dir = current_dir.parent
+    source = Path(args.source) if args.source else Path(parent_dir) / "phallett" / "data" / "Taxa_Selected"
+    outdir = Path(args.outdir) if args.outdir else Path(parent_dir) / "phallett" / "test" / "Metrics_Results"
+    outdir.mkdir(parents=True, exist_ok=True)
+    store = None
+    if not args.no_store:
+        store = SketchStore(args.store if args.store else Path(parent_dir) / "phallett" / "data" / "Sketch_Store")
+
+    kmers = [int(k) for k in args.kmers.replace(" ", ",").split(",") if k]
+    if any(k > 32 for k in kmers):
+        parser.error("k-mer sizes above 32 are not supported")
+    genera = [source / args.genus] if args.genus else sorted(d for d in source.iterdir() if d.is_dir())
+    for genus_dir in genera:
+        run_genus(genus_dir, outdir, kmers, args.sketch_size, store, args.max_distance, args.memory_mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from results_io import read_table
+from pair_keys import GenomeDictionary, table_pair_keys, unpack_pairs, pair_frame
+
+# Sparse neighbor graph of the genomes of Metrics_Results, for "nearest references to this genome".
+# Only pairs closer than a cut-off are kept (Mash distance under max_distance, or ANI over min_ani),
+# stored in CSR form: the neighbors of genome i are indices[indptr[i]:indptr[i + 1]], sorted by
+# distance, so a nearest-n query is one slice. ANI is stored as the distance 1 - ANI / 100.
+# The graph is symmetric, A-B and B-A are one pair with the mean distance of both directions, and the
+# cut-off applies to that mean. One kmer is used (the largest in the tables unless one is given), the
+# distances of different kmers are not on the same scale.
+DEFAULT_ALGORITHMS = {"ani": "fastani", "mash": "mash"}
+DEFAULT_MAX_DISTANCE = 0.2
+DEFAULT_MIN_ANI = 80.0
+INDEX_NAME = "neighbors_{metric}.npz"
+
+
+class NeighborIndex:
+    def __init__(self, names, indptr, indices, distances, metric):
+        self.genomes = GenomeDictionary(names)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.metric = metric
+
+    @classmethod
+    def from_pairs(cls, genomes, keys, distances, metric):
+        # Symmetric CSR from canonical pair keys, each row sorted by distance
+        ids_a, ids_b = unpack_pairs(keys)
+        rows = np.concatenate([ids_a, ids_b])
+        columns = np.concatenate([ids_b, ids_a])
+        values = np.concatenate([distances, distances])
+        order = np.lexsort((values, rows))
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(genomes)))))
+        return cls(genomes.names, indptr, columns[order], values[order], metric)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["names"].astype(str), data["indptr"], data["indices"], data["distances"], str(data["metric"]))
+
+    def save(self, path):
+        tmp_path = Path(path).with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, names=self.genomes.names.to_numpy(dtype=str), indptr=self.indptr, indices=self.indices,
+                 distances=self.distances, metric=self.metric)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.genomes)
+
+    def __contains__(self, genome):
+        return self.genomes.ids([genome])[0] >= 0
+
+    @property
+    def pairs(self):
+        return len(self.indices) // 2
+
+    def nearest(self, genome, n=10, max_distance=None):
+        # Closest neighbors of a genome as a DataFrame (genome, distance[, ani]), empty when unknown
+        genome_id = self.genomes.ids([genome])[0]
+        if genome_id < 0:
+            return pd.DataFrame(columns=["genome", "distance"])
+        start, end = self.indptr[genome_id], self.indptr[genome_id + 1]
+        neighbors = self.indices[start:end][:n]
+        distances = self.distances[start:end][:n]
+        if max_distance is not None:
+            neighbors = neighbors[distances <= max_distance]
+            distances = distances[distances <= max_distance]
+        result = pd.DataFrame({"genome": self.genomes.names[neighbors], "distance": distances})
+        if self.metric == "ani":
+            result["ani"] = 100 * (1 - result["distance"])
+        return result
+
+
+def default_kmer(workdir, genera, metric, algorithm):
+    # Largest numeric kmer of the algorithm over every genus, or its only label (skani "static")
+    kmers = set()
+    for genus in genera:
+        table = read_table(os.path.join(workdir, genus), f"{metric}_metrics", genus,
+                           columns=[f"kmer_{metric}", f"algorithm_{metric}"])
+        if table is not None:
+            kmers |= set(table.loc[table[f"algorithm_{metric}"].astype(str) == algorithm, f"kmer_{metric}"].astype(str))
+    numeric = [int(k) for k in kmers if k.isdigit()]
+    if numeric:
+        return str(max(numeric))
+    return max(kmers) if kmers else None
+
+
+def metric_pairs(table, metric, algorithm, kmer):
+    # Distance of each directed pair for one algorithm and kmer
+    table = table[(table[f"algorithm_{metric}"].astype(str) == algorithm) & (table[f"kmer_{metric}"].astype(str) == str(kmer))]
+    distances = table[f"{metric}_distance"].to_numpy(dtype=float)
+    if metric == "ani":
+        distances = 1 - distances / 100
+    return table[["GenomeA", "GenomeB"]], distances
+
+
+def mean_pairs(pairs, distances):
+    # Mean distance of each canonical pair over both directions, self pairs dropped
+    genomes = GenomeDictionary.from_tables(pairs)
+    keys, distinct = table_pair_keys(pairs, genomes)
+    mean = pd.Series(distances[distinct]).groupby(keys[distinct]).mean()
+    return pair_frame(mean.index.to_numpy(), genomes), mean.to_numpy()
+
+
+def build_index(workdir, metric="mash", algorithm=None, kmer=None, max_distance=DEFAULT_MAX_DISTANCE,
+                min_ani=DEFAULT_MIN_ANI, genera=None):
+    # Neighbor graph over the <metric>_metrics tables of every genus of workdir
+    algorithm = algorithm or DEFAULT_ALGORITHMS[metric]
+    cutoff = 1 - min_ani / 100 if metric == "ani" else max_distance
+    genera = genera or sorted(d for d in os.listdir(workdir) if os.path.isdir(os.path.join(workdir, d)))
+    kmer = kmer if kmer is not None else default_kmer(workdir, genera, metric, algorithm)
+    if kmer is None:
+        print(f"No {algorithm} {metric} distances in {workdir}")
+        genera = []
+    else:
+        print(f"Neighbor index from {algorithm} {metric} distances with kmer {kmer}")
+    frames, distances = [], []
+    for genus in genera:
+        table = read_table(os.path.join(workdir, genus), f"{metric}_metrics", genus,
+                           columns=["GenomeA", "GenomeB", f"{metric}_distance", f"kmer_{metric}", f"algorithm_{metric}"])
+        if table is None:
+            continue
+        pairs, values = mean_pairs(*metric_pairs(table, metric, algorithm, kmer))
+        # The cut-off applies to the mean of both directions, not to each direction
+        keep = values <= cutoff
+        frames.append(pairs[keep])
+        distances.append(values[keep])
+    pairs = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["GenomeA", "GenomeB"])
+    genomes = GenomeDictionary.from_tables(pairs)
+    if pairs.empty:
+        return NeighborIndex(genomes.names, np.zeros(len(genomes) + 1), [], [], metric)
+    # A pair stored in two genera keeps the mean of both
+    keys, _ = table_pair_keys(pairs, genomes)
+    mean = pd.Series(np.concatenate(distances)).groupby(keys).mean()
+    return NeighborIndex.from_pairs(genomes, mean.index.to_numpy(), mean.to_numpy(), metric)
+
+
+def index_path(workdir, metric):
+    return os.path.join(workdir, INDEX_NAME.format(metric=metric))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the sparse neighbor index of the metric tables.')
+    parser.add_argument('-workdir', type=str, help='Metrics_Results directory')
+    parser.add_argument('-metric', type=str, default="mash", choices=["mash", "ani"], help='Metric table the graph is built from')
+    parser.add_argument('-algorithm', type=str, help='Algorithm of the metric, fastani for ani and mash for mash by default')
+    parser.add_argument('-kmer', type=str, help='Kmer of the distances, the largest kmer in the tables by default')
+    parser.add_argument('-max_distance', type=float, default=DEFAULT_MAX_DISTANCE, help='Mash distance cut-off')
+    parser.add_argument('-min_ani', type=float, default=DEFAULT_MIN_ANI, help='ANI floor')
+    parser.add_argument('-query', type=str, help='Comma separated genomes, print their nearest neighbors instead of building')
+    parser.add_argument('-n', type=int, default=10, help='Neighbors printed per query genome')
+    args = parser.parse_args()
+
+    # Set paths
+    current_dir = Path.cwd()
+    parent_dir = current_dir.parent
+    workdir = args.workdir or os.path.expanduser((Path(parent_dir) / "phallett" / "test" / "Metrics_Results"))
+    path = index_path(workdir, args.metric)
+
+    if args.query:
+        index = NeighborIndex.load(path)
+        for genome in args.query.split(","):
+            neighbors = index.nearest(genome, args.n)
+            print(f"{genome}: {len(neighbors)} neighbors" if len(neighbors) else f"{genome}: not in the index")
+            if len(neighbors):
+                print(neighbors.to_string(index=False))
+        return
+
+    index = build_index(workdir, args.metric, args.algorithm, args.kmer, args.max_distance, args.min_ani)
+    index.save(path)
+    print(f"Neighbor index of {len(index)} genomes and {index.pairs} pairs written to {path}")
+
+
+if __name__ == "__main__":
+    main()
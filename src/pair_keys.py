@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+# Integer genome ids and packed pair keys for the pair tables of a genus.
+# A genome dictionary maps every genome of the genus to an id (its position in the sorted names), and a
+# pair is one int64 (smaller id << 32 | larger id), so A-B and B-A get the same key and joins and
+# duplicate checks hash integers instead of two accession strings per row.
+ID_BITS = 32
+
+
+class GenomeDictionary:
+    def __init__(self, names):
+        self.names = pd.Index(sorted(set(str(name) for name in names)), dtype=object)
+
+    @classmethod
+    def from_tables(cls, *tables):
+        # Genomes of the GenomeA and GenomeB columns of the tables
+        names = set()
+        for table in tables:
+            if table is not None and not table.empty:
+                names.update(pd.unique(table["GenomeA"].astype(str)))
+                names.update(pd.unique(table["GenomeB"].astype(str)))
+        return cls(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def ids(self, genomes):
+        # Id of each genome, -1 when it is not in the dictionary
+        return self.names.get_indexer(pd.Series(genomes).astype(str)).astype(np.int64)
+
+    def genomes(self, ids, categorical=True):
+        # Names of the ids, as a categorical over the dictionary so names are stored once
+        if categorical:
+            return pd.Categorical.from_codes(ids, categories=self.names)
+        return self.names.to_numpy()[ids]
+
+
+def pack_pairs(ids_a, ids_b, canonical=True):
+    # One int64 per pair, ordered (smaller id first) unless canonical is False
+    ids_a = np.asarray(ids_a, dtype=np.int64)
+    ids_b = np.asarray(ids_b, dtype=np.int64)
+    if canonical:
+        ids_a, ids_b = np.minimum(ids_a, ids_b), np.maximum(ids_a, ids_b)
+    return (ids_a << ID_BITS) | ids_b
+
+
+def unpack_pairs(keys):
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> ID_BITS, keys & ((1 << ID_BITS) - 1)
+
+
+def table_pair_keys(table, genomes, canonical=True):
+    # Pair keys of the rows of a table and a mask of the rows that are not self comparisons
+    ids_a = genomes.ids(table["GenomeA"])
+    ids_b = genomes.ids(table["GenomeB"])
+    return pack_pairs(ids_a, ids_b, canonical), ids_a != ids_b
+
+
+def pair_frame(keys, genomes):
+    # GenomeA and GenomeB columns of packed pair keys
+    ids_a, ids_b = unpack_pairs(keys)
+    return pd.DataFrame({"GenomeA": genomes.genomes(ids_a), "GenomeB": genomes.genomes(ids_b)})
@@ -0,0 +1,104 @@
+import os
+import argparse
+import pandas as pd
+from pathlib import Path
+from results_io import read_table
+from pair_keys import GenomeDictionary, pack_pairs
+
+# Pair-level result store for the metric tables (ani_metrics_<genus>, mash_metrics_<genus>).
+# Rows are keyed by (GenomeA, GenomeB, algorithm, kmer); new results are merged into the stored
+# table instead of rebuilding it, and the metric stages ask which genomes still have no pairs so
+# that only the new x all comparisons are computed when a genus grows.
+LEGACY_FRAGMENT_LENGTH = 500
+
+
+def genome_name(path):
+    # /path/to/AB008550.fasta -> AB008550
+    return os.path.basename(str(path)).replace(".fasta", "")
+
+
+def fragment_lengths(df):
+    # Fragment length of every row (fastANI, native engine) as an integer, -1 when it has none (skani, mash)
+    if "fragment_length" not in df.columns:
+        return pd.Series(-1, index=df.index)
+    return pd.to_numeric(df["fragment_length"], errors="coerce").fillna(-1).astype(int)
+
+
+def pair_key(df, metric, genomes):
+    # Directed pair key (both directions of fastANI are kept), algorithm, kmer and fragment length as
+    # integer codes
+    return pd.DataFrame({"pair": pack_pairs(genomes.ids(df["GenomeA"]), genomes.ids(df["GenomeB"]), canonical=False),
+                         "algorithm": pd.factorize(df[f"algorithm_{metric}"].astype(str))[0],
+                         "kmer": pd.factorize(df[f"kmer_{metric}"].astype(str))[0],
+                         "fragment_length": fragment_lengths(df).to_numpy()})
+
+
+def merge_pairs(stored, new, metric, genomes=None):
+    # Add new results to the stored table, a recomputed pair replaces the stored one
+    # With genomes, pairs of genomes no longer in the genus are dropped
+    merged = pd.concat([stored, new], ignore_index=True)
+    if merged.empty:
+        return merged
+    if "fragment_length" in merged.columns:
+        # fastANI rows stored before the fragment length was recorded were run with the default fragLen,
+        # the native engine (its own algorithm label) always records it
+        legacy = merged["fragment_length"].isna() & (merged[f"algorithm_{metric}"].astype(str) == "fastani")
+        merged.loc[legacy, "fragment_length"] = LEGACY_FRAGMENT_LENGTH
+    dictionary = GenomeDictionary.from_tables(merged)
+    merged = merged[~pair_key(merged, metric, dictionary).duplicated(keep="last").to_numpy()]
+    if genomes is not None:
+        current = GenomeDictionary(genomes)
+        merged = merged[(current.ids(merged["GenomeA"]) >= 0) & (current.ids(merged["GenomeB"]) >= 0)]
+    return merged.reset_index(drop=True)
+
+
+def update_table(directory, name, genus, new, metric, genomes=None):
+    # Merge new results into the stored table (CSV or Parquet) and return the full table
+    stored = read_table(directory, name, genus)
+    if stored is None:
+        stored = pd.DataFrame(columns=new.columns)
+    merged = merge_pairs(stored, new, metric, genomes)
+    print(f"{name}_{genus}: {len(stored)} stored pairs, {len(new)} new results, {len(merged)} pairs")
+    return merged
+
+
+def stored_genomes(directory, genus, metric, algorithm, kmer, fragment_length=None):
+    # Genomes that already have computed pairs for this algorithm and kmer (and fragment length),
+    # the pairs skipped by the ANI prefilter (no distance) do not count
+    table = read_table(directory, f"{metric}_metrics", genus,
+                       columns=["GenomeA", "GenomeB", f"{metric}_distance", f"algorithm_{metric}", f"kmer_{metric}"],
+                       optional=["fragment_length"])
+    if table is None:
+        return set()
+    table = table[(table[f"algorithm_{metric}"].astype(str) == algorithm) & (table[f"kmer_{metric}"].astype(str) == str(kmer))
+                  & table[f"{metric}_distance"].notna()]
+    if fragment_length is not None:
+        lengths = fragment_lengths(table).replace(-1, LEGACY_FRAGMENT_LENGTH)
+        table = table[lengths == int(fragment_length)]
+    return set(table["GenomeA"].astype(str)) | set(table["GenomeB"].astype(str))
+
+
+def new_genomes(genome_paths, directory, genus, metric, algorithm, kmer, fragment_length=None):
+    done = stored_genomes(directory, genus, metric, algorithm, kmer, fragment_length)
+    return [path for path in genome_paths if genome_name(path) not in done]
+
+
+def main():
+    # Print the genomes of a .list file that have no stored pairs yet, used by the metric shell stages
+    parser = argparse.ArgumentParser(description='List genomes without stored pairs.')
+    parser.add_argument('-dir', type=str, required=True, help='Metrics_Results directory of the genus')
+    parser.add_argument('-genus', type=str, required=True, help='Genus name')
+    parser.add_argument('-metric', type=str, default="ani", help='ani or mash')
+    parser.add_argument('-algorithm', type=str, required=True, help='Algorithm, e.g. fastani, native_ani (fragment_ani.py) or skani')
+    parser.add_argument('-kmer', type=str, required=True, help='k-mer size, or static for skani')
+    parser.add_argument('-fragment_length', type=int, help='Fragment length (fastani, native_ani), all by default')
+    parser.add_argument('-list', type=str, required=True, help='File with one genome path per line')
+    args = parser.parse_args()
+
+    genome_paths = [line.strip() for line in Path(args.list).read_text().splitlines() if line.strip()]
+    for path in new_genomes(genome_paths, args.dir, args.genus, args.metric, args.algorithm, args.kmer, args.fragment_length):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
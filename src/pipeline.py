@@ -0,0 +1,277 @@
+import os
+import re
+import csv
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from glob import glob
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Dependency-aware runner for the phallett modules, used by phallet.sh.
+# Every stage declares its command, the input files it reads, the outputs it must leave behind and the
+# stages it depends on. A stage is skipped when its stamp is newer than its inputs, no dependency ran
+# again and its command did not change, so after a failure or a one-genus change only the affected
+# stages run. Independent stages (ANI and Mash of different genera) run concurrently with -jobs.
+REPO_DIR = Path(__file__).resolve().parent.parent
+STATE_DIR = REPO_DIR / ".pipeline"
+MODULES = ["ictv", "taxa", "file", "bargenome", "derep", "ani", "mash", "wraggling", "graphs", "neighbors", "alignment", "boxplot"]
+DEFAULT_MODULES = ["ictv", "taxa", "bargenome", "ani", "mash", "wraggling", "graphs"]
+
+
+class Stage:
+    def __init__(self, name, command, inputs=(), outputs=(), deps=(), cwd=REPO_DIR, always=False):
+        self.name = name
+        self.command = [str(c) for c in command]
+        self.inputs = [str(i) for i in inputs]  # files or glob patterns
+        self.outputs = [str(o) for o in outputs]  # files or glob patterns (** for any directory depth)
+        self.deps = list(deps)
+        self.cwd = cwd
+        # Stages whose every run is new work (a new analysis folder) are never taken as up to date
+        self.always = always
+
+    def state_file(self, kind, suffix):
+        return STATE_DIR / kind / f"{self.name.replace(':', '_')}{suffix}"
+
+    @property
+    def stamp(self):
+        return self.state_file("stamps", ".done")
+
+    @property
+    def log(self):
+        return self.state_file("logs", ".log")
+
+    def input_files(self):
+        return sorted({file for pattern in self.inputs for file in glob(pattern)})
+
+    def input_digest(self):
+        # Hash of the list of input files, a removed (or added) input makes the stage stale
+        return hashlib.sha256("\n".join(self.input_files()).encode()).hexdigest()
+
+    def stale_reason(self):
+        # Why the stage has to run, None when it is up to date
+        if self.always:
+            return "always run"
+        if not self.stamp.exists():
+            return "never run"
+        stamp = json.loads(self.stamp.read_text())
+        if stamp.get("command") != self.command:
+            return "command changed"
+        if stamp.get("inputs") != self.input_digest():
+            return "input files added or removed"
+        missing = [o for o in self.outputs if not glob(o, recursive=True)]
+        if missing:
+            return f"{missing[0]} is missing"
+        built = self.stamp.stat().st_mtime
+        for file in self.input_files():
+            if os.path.getmtime(file) > built:
+                return f"{file} changed"
+        return None
+
+
+def run_stage(stage):
+    # The stamp is dropped first, a stage that fails is never taken as up to date on the next run
+    stage.stamp.unlink(missing_ok=True)
+    stage.log.parent.mkdir(parents=True, exist_ok=True)
+    start = time.time()
+    with open(stage.log, "w") as log:
+        returncode = subprocess.run(stage.command, cwd=stage.cwd, stdout=log, stderr=subprocess.STDOUT).returncode
+    seconds = round(time.time() - start, 1)
+    if returncode == 0:
+        stage.stamp.parent.mkdir(parents=True, exist_ok=True)
+        # The input list is taken after the run, stages like derep change their own inputs
+        stage.stamp.write_text(json.dumps({"command": stage.command, "inputs": stage.input_digest(), "seconds": seconds}) + "\n")
+    return returncode, seconds
+
+
+def run_pipeline(stages, jobs=1, force=False, dry_run=False):
+    # Run the stages in dependency order, up to jobs at a time
+    # Dependencies outside the selected modules are taken as already satisfied
+    status = {}
+    seconds = {}
+    pending = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            progress = False
+            for name, stage in list(pending.items()):
+                deps = [d for d in stage.deps if d in stages]
+                if any(status.get(d) in ("failed", "blocked") for d in deps):
+                    status[name] = "blocked"
+                    del pending[name]
+                    progress = True
+                    print(f"[blocked] {name}: a dependency failed")
+                    continue
+                if not all(status.get(d) in ("done", "up to date") for d in deps):
+                    continue
+                del pending[name]
+                progress = True
+                reran = [d for d in deps if status[d] == "done"]
+                reason = "forced" if force else (f"{reran[0]} ran again" if reran else stage.stale_reason())
+                if reason is None:
+                    status[name] = "up to date"
+                    print(f"[skip] {name}: up to date")
+                elif dry_run:
+                    status[name] = "done"
+                    print(f"[run] {name}: {reason}\n      {' '.join(stage.command)}")
+                else:
+                    print(f"[start] {name}: {reason}")
+                    running[executor.submit(run_stage, stage)] = name
+
+            if not running:
+                if not progress and pending:
+                    raise RuntimeError(f"Unresolvable dependencies: {', '.join(pending)}")
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    returncode, seconds[name] = future.result()
+                except OSError as e:
+                    returncode, seconds[name] = str(e), 0.0
+                status[name] = "done" if returncode == 0 else "failed"
+                print(f"[{status[name]}] {name} ({seconds[name]} s)" +
+                      ("" if returncode == 0 else f", see {stages[name].log}"))
+    return status, seconds
+
+
+def write_run_summary(stages, status, seconds):
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(STATE_DIR / "last_run.tsv", "w", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t")
+        writer.writerow(["stage", "status", "seconds", "log"])
+        for name in stages:
+            writer.writerow([name, status.get(name, ""), seconds.get(name, ""),
+                             stages[name].log if name in seconds else ""])
+
+
+def split_values(value):
+    # "12 11 10" and "12,11,10" are both accepted, as in the module scripts
+    return [v for v in re.split(r"[ ,]+", str(value)) if v]
+
+
+def build_stages(args):
+    data_dir = REPO_DIR / "data"
+    taxa_dir = data_dir / "Taxa_Selected"
+    members_dir = data_dir / "Taxa_Members"
+    metrics_dir = REPO_DIR / "test" / "Metrics_Results"
+    vmr = data_dir / "Virus_Metadata_Resource" / "VMR.csv"
+    neighbors = metrics_dir / "neighbors_mash.npz"
+
+    modules = split_values(args.m) if args.m else DEFAULT_MODULES
+    unknown = [m for m in modules if m not in MODULES]
+    if unknown:
+        raise ValueError(f"Unknown modules: {', '.join(unknown)}, choose from {', '.join(MODULES)}")
+    if args.g:
+        genera = split_values(args.g)
+    else:
+        genera = [line.strip() for line in Path(args.d).read_text().splitlines() if line.strip()]
+
+    stages = {}
+
+    def add(module, stage):
+        if module in modules:
+            stages[stage.name] = stage
+
+    add("ictv", Stage("ictv", ["bash", "src/00.ICTV_Metadata_Resource.sh"], outputs=[vmr]))
+    for genus in genera:
+        add("taxa", Stage(f"taxa:{genus}", ["python3", "src/01A.Taxa_Curation_Level.py", genus],
+                          inputs=[vmr], outputs=[taxa_dir / genus], deps=["ictv"]))
+    neighbor_options = ["-n", neighbors] if args.use_neighbors else []
+    # Every 01B run searches the query again into a new analysis_N folder, there is no fixed output
+    add("file", Stage("file", ["bash", "src/01B.Selecting_file.sh", "-f", args.fl, "-b", args.b, "-e", args.e, "-u", args.u] + neighbor_options,
+                      inputs=[args.fl], deps=["ictv"] + (["neighbors"] if args.use_neighbors else []), always=True))
+
+    taxa_stages = [f"taxa:{genus}" for genus in genera]
+    add("bargenome", Stage("bargenome", ["python3", "src/02.Bargenome.py", REPO_DIR.parent, "--format", args.format],
+                           inputs=[vmr, taxa_dir / "*" / "*.fasta"], deps=taxa_stages))
+
+    for genus in genera:
+        genomes = taxa_dir / genus / "*.fasta"
+        # Dereplication leaves only the cluster representatives in Taxa_Selected for the metric stages
+        add("derep", Stage(f"derep:{genus}", ["python3", "src/dereplicate.py", "-genus", genus, "-identity", args.derep_identity],
+                           inputs=[genomes], outputs=[members_dir / genus / f"clusters_{genus}.tsv"],
+                           deps=[f"taxa:{genus}", "bargenome"]))
+        # The ANI prefilter reuses the mash distances of the genus when the mash stage ran first
+        prefilter_options = ["-p", args.prefilter] if args.prefilter is not None else []
+        # Raw outputs stay in Metrics_Results until 05 moves them into the genus directory
+        add("ani", Stage(f"ani:{genus}", ["bash", "src/03.ANI_Metrics.sh", "-g", genus, "-k", " ".join(split_values(args.ka)),
+                                          "-f", " ".join(split_values(args.f)), "-e", args.ani_engine] + prefilter_options,
+                         inputs=[genomes], outputs=[metrics_dir / "**" / f"skani_distance_{genus}.txt"],
+                         deps=[f"taxa:{genus}", f"derep:{genus}"] + ([f"mash:{genus}"] if args.prefilter is not None else [])))
+        mash_options = ["-t", args.max_distance] if args.max_distance is not None else []
+        add("mash", Stage(f"mash:{genus}", ["bash", "src/04.Mash_Metrics.sh", "-g", genus, "-k", ",".join(split_values(args.km)),
+                                            "-e", args.engine] + mash_options,
+                          inputs=[genomes], outputs=[metrics_dir / "**" / f"mash_distance_{genus}_k*.tab"],
+                          deps=[f"taxa:{genus}", f"derep:{genus}"]))
+        # 05 reads the raw outputs wherever they are (moved or not) and the stored metric tables, so a
+        # metric stage run on its own makes wraggling stale even when it was not selected with it
+        genus_dir = metrics_dir / genus
+        raw_outputs = [directory / pattern for directory in (metrics_dir, genus_dir)
+                       for pattern in (f"fastani_{genus}_*", f"native_ani_{genus}_*", f"skani_distance_{genus}*", f"mash_distance_{genus}_*",
+                                       f"sourmash_distance_{genus}_*", f"ani_skipped_{genus}.tsv")]
+        metric_tables = [genus_dir / f"{metric}_metrics_{genus}.*" for metric in (args.mx, args.my)]
+        add("wraggling", Stage(f"wraggling:{genus}", ["python3", "src/05.wraggling.py", "-mx", args.mx, "-kmersx", ",".join(split_values(args.kx)),
+                                                      "-my", args.my, "-kmersy", ",".join(split_values(args.ky)),
+                                                      "-format", args.format, "-genus", genus],
+                               inputs=raw_outputs + metric_tables, outputs=[genus_dir / f"summary_{genus}.*"],
+                               deps=[f"ani:{genus}", f"mash:{genus}"]))
+        add("graphs", Stage(f"graphs:{genus}", ["python3", "src/06.Graphing.py", "-mx", args.mx, "-kmersx", ",".join(split_values(args.kx)),
+                                                "-my", args.my, "-kmersy", ",".join(split_values(args.ky)), "-genus", genus],
+                            inputs=metric_tables, outputs=[genus_dir / f"{genus}_*.pdf"],
+                            deps=[f"wraggling:{genus}"]))
+
+    add("neighbors", Stage("neighbors", ["python3", "src/neighbor_index.py", "-workdir", metrics_dir, "-metric", "mash"],
+                           inputs=[metrics_dir / "*" / "mash_metrics_*"], outputs=[neighbors],
+                           deps=[f"wraggling:{genus}" for genus in genera]))
+    add("alignment", Stage("alignment", ["python3", "src/alignment_fraction.py", "-workdir", metrics_dir],
+                           deps=[f"wraggling:{genus}" for genus in genera]))
+    # 07 resolves its paths from src/
+    add("boxplot", Stage("boxplot", ["python3", "src/07.Summary_Feed.py"],
+                         inputs=[taxa_dir / "*" / "*.fasta"], deps=taxa_stages, cwd=REPO_DIR / "src"))
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the phallett modules, skipping the ones that are up to date.')
+    parser.add_argument('-d', type=str, default=str(REPO_DIR / "test_genus.txt"), help='File with the genera to analyse')
+    parser.add_argument('-m', type=str, help=f'Comma separated modules ({", ".join(MODULES)}), default {",".join(DEFAULT_MODULES)}')
+    parser.add_argument('-g', type=str, help='Genus or comma separated genera, overrides -d')
+    parser.add_argument('-ka', type=str, default="12 11 10 9 8", help='Kmers for ani metrics')
+    parser.add_argument('-km', type=str, default="7 9 11 12 13", help='Kmers for mash metrics')
+    parser.add_argument('-f', type=str, default="500", help='Fragment lengths for ANI')
+    parser.add_argument('-kx', type=str, default="12,11,10,9,8", help='Kmers used on x metric')
+    parser.add_argument('-ky', type=str, default="7,9,11,12,13", help='Kmers used on y metric')
+    parser.add_argument('-mx', type=str, default="ani", help='Metric in x scatter axis')
+    parser.add_argument('-my', type=str, default="mash", help='Metric in y scatter axis')
+    parser.add_argument('-fl', type=str, default=str(REPO_DIR / "GCF_000836945.fasta"), help='Query file for the file module')
+    parser.add_argument('-u', type=str, default="false", help='Update the BLAST database (true, full or false)')
+    parser.add_argument('-b', type=str, default="0.75", help='BLAST identity proportion')
+    parser.add_argument('-e', type=str, default="1e-5", help='BLAST e-value')
+    parser.add_argument('-engine', type=str, default="mash", choices=["mash", "native"], help='Mash engine')
+    parser.add_argument('-max_distance', type=float, help='Native mash engine: only keep pairs at this distance or closer')
+    parser.add_argument('-ani_engine', type=str, default="fastani", choices=["fastani", "native"], help='ANI engine')
+    parser.add_argument('-prefilter', type=float, help='ANI only for pairs at this mash distance or closer, the rest are recorded as skipped')
+    parser.add_argument('-derep_identity', type=float, default=95.0, help='Identity (1 - mash distance) of the derep clusters')
+    parser.add_argument('-use_neighbors', action='store_true', help='The file module takes known queries from the neighbor index instead of BLAST')
+    parser.add_argument('-format', type=str, default="csv", choices=["csv", "parquet"], help='Format of the metric tables')
+    parser.add_argument('-jobs', '-j', type=int, default=1, help='Stages run at the same time')
+    parser.add_argument('-force', action='store_true', help='Run the selected stages even when up to date')
+    parser.add_argument('-dry_run', action='store_true', help='Only print the stages that would run')
+    args = parser.parse_args()
+
+    stages = build_stages(args)
+    print(f"{len(stages)} stages selected")
+    status, seconds = run_pipeline(stages, jobs=max(1, args.jobs), force=args.force, dry_run=args.dry_run)
+    if args.dry_run:
+        return 0
+    write_run_summary(stages, status, seconds)
+    counts = {s: list(status.values()).count(s) for s in ("done", "up to date", "failed", "blocked")}
+    print(", ".join(f"{n} {s}" for s, n in counts.items()) + f", summary in {STATE_DIR / 'last_run.tsv'}")
+    return 1 if counts["failed"] or counts["blocked"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
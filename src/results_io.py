@@ -0,0 +1,76 @@
+import os
+import pandas as pd
+
+# Reading and writing of the Metrics_Results tables (ani_metrics, mash_metrics, summary, metadata)
+# as CSV or, when pyarrow is installed, as Parquet with categorical genome ids and typed kmer and
+# algorithm columns. Readers pick whichever file of a table is newest and only load the columns asked for.
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+FORMATS = {"csv": ".csv", "parquet": ".parquet"}
+
+
+def resolve_format(fmt):
+    if fmt == "parquet" and not HAS_PYARROW:
+        print("Warning: pyarrow is not installed, writing CSV instead of Parquet")
+        return "csv"
+    return fmt
+
+
+def table_path(directory, name, genus, fmt="csv"):
+    return os.path.join(directory, f"{name}_{genus}{FORMATS[fmt]}")
+
+
+def find_table(directory, name, genus):
+    # Newest existing file of the table, None when it was never written
+    candidates = [table_path(directory, name, genus, fmt) for fmt in FORMATS
+                  if fmt == "csv" or HAS_PYARROW]
+    candidates = [path for path in candidates if os.path.exists(path)]
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+def typed_columns(df):
+    # Categorical genome ids and algorithms, integer kmers (categorical when mixed with "static")
+    df = df.copy()
+    for column in df.columns:
+        if column in ("GenomeA", "GenomeB") or column.startswith("algorithm"):
+            df[column] = df[column].astype(str).astype("category")
+        elif column.startswith("kmer"):
+            numeric = pd.to_numeric(df[column], errors="coerce")
+            if numeric.notna().all():
+                df[column] = numeric.astype("int16")
+            else:
+                df[column] = df[column].astype(str).astype("category")
+        elif df[column].dtype == object:
+            df[column] = df[column].astype("string")
+    return df
+
+
+def write_table(df, directory, name, genus, fmt="csv"):
+    fmt = resolve_format(fmt)
+    path = table_path(directory, name, genus, fmt)
+    if fmt == "parquet":
+        typed_columns(df).to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def read_table(directory, name, genus, columns=None, optional=()):
+    # optional: columns also loaded when the table has them (tables written before they existed lack them)
+    path = find_table(directory, name, genus)
+    if path is None:
+        return None
+    if path.endswith(".parquet"):
+        if columns is not None and optional:
+            import pyarrow.parquet as pq
+            names = pq.read_schema(path).names
+            columns = list(columns) + [c for c in optional if c in names]
+        return pd.read_parquet(path, columns=columns)
+    if columns is not None and optional:
+        wanted = set(columns) | set(optional)
+        return pd.read_csv(path, usecols=lambda c: c in wanted)
+    return pd.read_csv(path, usecols=columns)
@@ -0,0 +1,87 @@
+import os
+import fcntl
+import hashlib
+import numpy as np
+from pathlib import Path
+
+# Persistent sketch index keyed by (accession, algorithm, k, sketch size).
+# Each (algorithm, k, sketch size) is one .npz file holding the hashes of all its genomes
+# concatenated in a single uint64 array plus offsets, so loading thousands of sketches is one read.
+# A content fingerprint is kept per genome, a genome whose FASTA changed is sketched again.
+# Several runs (mash, dereplicate, ani_prefilter) can share a store: save takes a lock on the table,
+# reads it again and adds only the sketches put by this run, so concurrent runs keep each other's.
+
+
+def genome_fingerprint(fasta_path):
+    digest = hashlib.sha256()
+    with open(fasta_path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+class SketchStore:
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.tables = {}
+        # Accessions put in this run, per (algorithm, k, sketch size)
+        self.dirty = {}
+
+    def table_path(self, algorithm, k, sketch_size):
+        return self.root / f"{algorithm}_k{k}_s{sketch_size}.npz"
+
+    @staticmethod
+    def read_entries(path):
+        # {accession: (fingerprint, genome length, hashes)} of a stored table
+        entries = {}
+        if path.exists():
+            with np.load(path) as data:
+                offsets = data["offsets"]
+                hashes = data["hashes"]
+                for i, accession in enumerate(data["accessions"]):
+                    entries[str(accession)] = (str(data["fingerprints"][i]), int(data["lengths"][i]),
+                                               hashes[offsets[i]:offsets[i + 1]])
+        return entries
+
+    def table(self, algorithm, k, sketch_size):
+        key = (algorithm, k, sketch_size)
+        if key not in self.tables:
+            self.tables[key] = self.read_entries(self.table_path(*key))
+        return self.tables[key]
+
+    def get(self, accession, algorithm, k, sketch_size, fingerprint=None):
+        # Stored (hashes, genome length), or None when missing or sketched from different content
+        entry = self.table(algorithm, k, sketch_size).get(accession)
+        if entry is None or (fingerprint is not None and entry[0] != fingerprint):
+            return None
+        return entry[2], entry[1]
+
+    def put(self, accession, algorithm, k, sketch_size, fingerprint, length, hashes):
+        self.table(algorithm, k, sketch_size)[accession] = (fingerprint, int(length), np.asarray(hashes, dtype=np.uint64))
+        self.dirty.setdefault((algorithm, k, sketch_size), set()).add(accession)
+
+    def save(self):
+        for key in sorted(self.dirty):
+            path = self.table_path(*key)
+            with open(path.with_suffix(".lock"), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # The table as other runs left it, plus the sketches of this run
+                entries = self.read_entries(path)
+                entries.update({accession: self.tables[key][accession] for accession in self.dirty[key]})
+                self.tables[key] = entries
+                self.write_entries(path, entries)
+        self.dirty.clear()
+
+    @staticmethod
+    def write_entries(path, entries):
+        accessions = sorted(entries)
+        sizes = [len(entries[a][2]) for a in accessions]
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(tmp_path,
+                 accessions=np.array(accessions, dtype=str),
+                 fingerprints=np.array([entries[a][0] for a in accessions], dtype=str),
+                 lengths=np.array([entries[a][1] for a in accessions], dtype=np.int64),
+                 offsets=np.concatenate(([0], np.cumsum(sizes))).astype(np.int64),
+                 hashes=np.concatenate([entries[a][2] for a in accessions]) if accessions else np.empty(0, dtype=np.uint64))
+        os.replace(tmp_path, path)
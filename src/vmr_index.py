@@ -0,0 +1,135 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from functools import lru_cache
+from vmr_sync import ACCESSION_PATTERN
+
+# VMR metadata indexed by GenBank accession.
+# The accession cells are split once (segmented genomes list one accession per segment, e.g.
+# "A: EU623082; B: EU623083") and every accession points to its VMR row, so the metadata of any
+# set of genomes comes from one vectorized lookup instead of a scan of the table per genome. The
+# segments of a row stay together as one record (one genome file named by its first accession).
+# Each VMR release is converted once into a cache next to VMR.csv (VMR.pkl) holding the normalized,
+# typed table and its indexes, including the complete genomes of bacterial and archaeal viruses.
+ACCESSION_COLUMN = "Virus_GENBANK_accession"
+CACHE_VERSION = 2
+CATEGORY_COLUMNS = ["Realm", "Subrealm", "Kingdom", "Subkingdom", "Phylum", "Subphylum", "Class", "Subclass",
+                    "Order", "Suborder", "Family", "Subfamily", "Genus", "Subgenus", "Exemplar_or_additional_isolate",
+                    "Genome_coverage", "Genome_composition", "Host_source"]
+PROKARYOTE_HOSTS = ["archaea", "bacteria"]
+COMPLETE_COVERAGE = ["Complete genome", "Complete coding genome"]
+
+
+def accession_keys(accessions):
+    # Accessions (or genome file names) without version, AB008550.1 -> AB008550
+    return pd.Series(accessions, dtype=object).astype(str).str.strip().str.split(".", n=1).str[0]
+
+
+class VMRIndex:
+    def __init__(self, vmr_df, column=ACCESSION_COLUMN):
+        self.table = vmr_df.reset_index(drop=True)
+        # Same parsing as vmr_sync.split_accessions, on the whole column at once
+        parts = self.table[column].dropna().astype(str).str.split(";").explode()
+        tokens = parts.str.split(":").str[-1].str.strip().str.split(" ", n=1).str[0]
+        tokens = tokens[tokens.str.match(ACCESSION_PATTERN.pattern)]
+        keys = accession_keys(tokens.values).values
+        first = ~pd.Index(keys).duplicated()
+        # An accession listed in several rows keeps its first row, as the old per-file lookups did
+        self.rows = pd.Series(tokens.index.values[first], index=keys[first])
+        # Accession as written in the VMR, with its version when the VMR pins one
+        self.versioned = pd.Series(tokens.values[first], index=keys[first])
+        # Accessions of every VMR row in segment order, a segmented genome is one record
+        self.segments = pd.Series(tokens.values[first], index=tokens.index.values[first])
+
+    @classmethod
+    def from_csv(cls, vmr_path, column=ACCESSION_COLUMN):
+        return cls(normalize_vmr(pd.read_csv(vmr_path)), column)
+
+    def __contains__(self, accession):
+        return accession_keys([accession]).iloc[0] in self.rows.index
+
+    def positions(self, accessions):
+        # Row of each accession in the table, -1 when it is not in the VMR
+        return self.rows.reindex(accession_keys(accessions).values).fillna(-1).astype(int).to_numpy()
+
+    def lookup(self, accessions, columns=None):
+        # VMR rows of the accessions found, in the given order, with the accession looked up first
+        accessions = np.asarray(accessions, dtype=object)
+        positions = self.positions(accessions)
+        found = positions >= 0
+        result = self.table.iloc[positions[found]]
+        if columns is not None:
+            result = result[columns]
+        result = result.reset_index(drop=True)
+        result.insert(0, "Accession", accessions[found])
+        return result
+
+    def annotate(self, accessions, column):
+        # Value of column for each accession, NaN when it is not in the VMR
+        positions = self.positions(accessions)
+        values = self.table[column].to_numpy(dtype=object)[np.maximum(positions, 0)]
+        values[positions < 0] = np.nan
+        return values
+
+    def accessions(self, genus=None):
+        # Single accessions of the table, or of one genus, as written in the VMR
+        if genus is None:
+            return list(self.versioned)
+        return list(self.versioned[self.table["Genus"].to_numpy()[self.rows.to_numpy()] == genus])
+
+    def records(self, genus=None):
+        # One list of accessions per VMR row (one genome), of the table or of one genus
+        segments = self.segments
+        if genus is not None:
+            segments = segments[self.table["Genus"].to_numpy()[segments.index.to_numpy()] == genus]
+        return [list(group) for _, group in segments.groupby(level=0, sort=True)]
+
+    def versions(self):
+        # {accession: version} with "" when the VMR does not pin a version, as vmr_sync.vmr_accessions
+        return {key: token.split(".", 1)[1] if "." in token else "" for key, token in self.versioned.items()}
+
+
+def normalize_vmr(vmr_df):
+    # Same column names in every stage ("Virus GENBANK accession" -> "Virus_GENBANK_accession")
+    vmr_df = vmr_df.rename(columns=lambda column: column.strip().replace(" ", "_"))
+    for column in CATEGORY_COLUMNS:
+        if column in vmr_df.columns:
+            vmr_df[column] = vmr_df[column].astype("category")
+    return vmr_df
+
+
+def complete_prokaryotic(vmr_df):
+    # Complete genomes of bacterial and archaeal viruses, the set 01A selects taxa from
+    return vmr_df[vmr_df["Host_source"].isin(PROKARYOTE_HOSTS) & vmr_df["Genome_coverage"].isin(COMPLETE_COVERAGE)]
+
+
+@lru_cache(maxsize=None)
+def load_vmr_cache(vmr_path):
+    # Indexes of a VMR release, rebuilt only when VMR.csv changed (size or mtime)
+    vmr_path = Path(vmr_path)
+    cache_path = vmr_path.with_suffix(".pkl")
+    stat = vmr_path.stat()
+    key = (CACHE_VERSION, stat.st_size, stat.st_mtime_ns)
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as handle:
+                cache = pickle.load(handle)
+            if cache.get("key") == key:
+                return cache
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            pass
+    table = normalize_vmr(pd.read_csv(vmr_path))
+    cache = {"key": key, "all": VMRIndex(table), "complete_prokaryotic": VMRIndex(complete_prokaryotic(table))}
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as handle:
+        pickle.dump(cache, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    print(f"VMR cache written to {cache_path}")
+    return cache
+
+
+def load_vmr_index(vmr_path, subset="all"):
+    # subset "all" or "complete_prokaryotic", one load per process shared by every caller
+    return load_vmr_cache(str(Path(vmr_path).resolve()))[subset]
@@ -0,0 +1,138 @@
+import re
+import csv
+import time
+import pandas as pd
+from pathlib import Path
+from genome_fetch import fetch_genomes, fetch_versions, base_accession
+from genome_store import fasta_version
+
+# Incremental sync of data/ICTV_database against the VMR.
+# The accessions of the last sync are kept in a snapshot, so a new VMR release only downloads
+# added accessions and version bumps, and removes the accessions that left the VMR.
+# The VMR rarely pins versions, so the current version of the unpinned accessions already synced
+# is looked up in NCBI (batched esummary) to find the version bumps.
+ACCESSION_PATTERN = re.compile(r"^[A-Z]{1,6}_?\d+(\.\d+)?$")
+SNAPSHOT_NAME = "vmr_snapshot.tsv"
+
+
+def split_accessions(cell):
+    # Parse a VMR accession cell into single accessions
+    # e.g. "A: EU623082; B: EU623083" -> ["EU623082", "EU623083"], "AE006468 (2844298.2877981)" -> ["AE006468"]
+    accessions = []
+    if pd.isna(cell):
+        return accessions
+    for part in str(cell).split(";"):
+        part = part.split(":")[-1].strip()
+        token = part.split(" ", 1)[0] if part else ""
+        if ACCESSION_PATTERN.match(token):
+            accessions.append(token)
+    return accessions
+
+
+def vmr_accessions(vmr_df, column="Virus GENBANK accession"):
+    # {accession: version} for every accession in the VMR, version is "" when the VMR does not pin one
+    accessions = {}
+    for cell in vmr_df[column].dropna():
+        for accession in split_accessions(cell):
+            version = accession.split(".", 1)[1] if "." in accession else ""
+            accessions[base_accession(accession)] = version
+    return accessions
+
+
+def load_snapshot(snapshot_path):
+    snapshot_path = Path(snapshot_path)
+    if not snapshot_path.exists():
+        return None
+    with open(snapshot_path, newline="") as handle:
+        return {row["accession"]: row["version"] for row in csv.DictReader(handle, delimiter="\t")}
+
+
+def save_snapshot(snapshot, snapshot_path):
+    with open(snapshot_path, "w", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t")
+        writer.writerow(["accession", "version"])
+        for accession in sorted(snapshot):
+            writer.writerow([accession, snapshot[accession]])
+
+
+def bootstrap_snapshot(database_dir):
+    # Without a previous snapshot, every genome already in the database counts as synced,
+    # at the version of its FASTA header
+    snapshot = {}
+    for file in Path(database_dir).glob("*.fasta"):
+        if ACCESSION_PATTERN.match(file.stem) and file.stat().st_size > 0:
+            snapshot[base_accession(file.stem)] = fasta_version(file)
+    return snapshot
+
+
+def diff_accessions(current, snapshot, database_dir):
+    # Compare the current VMR accessions with the snapshot
+    added = sorted(set(current) - set(snapshot))
+    removed = sorted(set(snapshot) - set(current))
+    changed = sorted(a for a in set(current) & set(snapshot)
+                     if current[a] and snapshot[a] and current[a] != snapshot[a])
+    # Accessions of the snapshot whose file is gone from the database are fetched again
+    missing = sorted(a for a in set(current) & set(snapshot)
+                     if a not in changed and not (Path(database_dir) / f"{a}.fasta").exists())
+    return {"added": added, "removed": removed, "changed": changed, "missing": missing}
+
+
+def sync_vmr(vmr_path, database_dir, store=None, full=False, check_versions=True):
+    # full: the snapshot is rebuilt from the genomes on disk instead of read, so every file is checked
+    # again (removed accessions deleted, versions compared with NCBI, missing ones fetched)
+    database_dir = Path(database_dir)
+    database_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_path = Path(vmr_path).parent / SNAPSHOT_NAME
+
+    # Accessions from the cached VMR index, VMR.csv is only parsed again when it changed
+    from vmr_index import load_vmr_index
+    current = load_vmr_index(vmr_path).versions()
+    snapshot = None if full else load_snapshot(snapshot_path)
+    if snapshot is None:
+        snapshot = bootstrap_snapshot(database_dir)
+        print(f"{'Full sync' if full else 'No VMR snapshot found'}, {len(snapshot)} genomes in {database_dir} "
+              f"taken at the version of their FASTA header")
+    if check_versions:
+        unpinned = sorted(a for a in set(current) & set(snapshot) if not current[a])
+        latest = fetch_versions(unpinned)
+        current = {a: version or latest.get(a, "") for a, version in current.items()}
+        print(f"NCBI versions of {len(latest)} of {len(unpinned)} synced accessions looked up")
+
+    delta = diff_accessions(current, snapshot, database_dir)
+    print(f"VMR sync: {len(delta['added'])} added, {len(delta['changed'])} changed, "
+          f"{len(delta['removed'])} removed, {len(delta['missing'])} missing on disk")
+
+    report = []
+    for accession in delta["removed"]:
+        file_path = database_dir / f"{accession}.fasta"
+        if file_path.exists():
+            file_path.unlink()
+        snapshot.pop(accession, None)
+        report.append((accession, "removed", "deleted"))
+
+    # Version bumps are requested with their new version so the store does not serve the old one
+    to_fetch = {a: (f"{a}.{current[a]}" if current[a] else a) for a in delta["added"] + delta["changed"] + delta["missing"]}
+    downloaded, failed = fetch_genomes(list(to_fetch.values()), database_dir, store=store)
+    failed = {base_accession(a) for a in failed}
+
+    for status in ("added", "changed", "missing"):
+        for accession in delta[status]:
+            if accession in failed:
+                report.append((accession, status, "failed"))
+                continue
+            # Keep the database named by accession without version, as the rest of the pipeline expects
+            fetched = database_dir / f"{to_fetch[accession]}.fasta"
+            if fetched.name != f"{accession}.fasta" and fetched.exists():
+                fetched.replace(database_dir / f"{accession}.fasta")
+            snapshot[accession] = current[accession] or fasta_version(database_dir / f"{accession}.fasta")
+            report.append((accession, status, "downloaded"))
+
+    # Failed accessions stay out of the snapshot so the next sync retries them
+    save_snapshot(snapshot, snapshot_path)
+    report_path = Path(vmr_path).parent / f"sync_report_{time.strftime('%Y%m%d-%H%M%S')}.tsv"
+    with open(report_path, "w", newline="") as handle:
+        writer = csv.writer(handle, delimiter="\t")
+        writer.writerow(["accession", "status", "result"])
+        writer.writerows(report)
+    print(f"Sync report saved to {report_path}")
+    return delta, report_path